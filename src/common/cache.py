@@ -1,8 +1,8 @@
-import json
 import os
 from datetime import datetime
 from os import path, remove
 
+import orjson
 from core_data_modules.util import IOUtils
 from engagement_database.data_models import Message
 from temba_client.v2 import Contact
@@ -50,27 +50,27 @@ class Cache:
         export_path = f"{self.cache_dir}/{entry_name}.json"
         temp_path = f"{self.cache_dir}/.{entry_name}_temp.json"
         IOUtils.ensure_dirs_exist_for_file(export_path)
-        with open(temp_path, "w") as f:
-            json.dump([c.serialize() for c in contacts], f)
+        with open(temp_path, "wb") as f:
+            f.write(orjson.dumps([c.serialize() for c in contacts]))
         os.replace(temp_path, export_path)
 
     def get_rapid_pro_contacts(self, entry_name):
         try:
-            with open(f"{self.cache_dir}/{entry_name}.json") as f:
-                return [Contact.deserialize(d) for d in json.load(f)]
+            with open(f"{self.cache_dir}/{entry_name}.json", "rb") as f:
+                return [Contact.deserialize(d) for d in orjson.loads(f.read())]
         except FileNotFoundError:
             return None
 
     def set_message(self, entry_name, message):
         export_path = f"{self.cache_dir}/{entry_name}.json"
         IOUtils.ensure_dirs_exist_for_file(export_path)
-        with open(export_path, "w") as f:
-            json.dump(message.to_dict(serialize_datetimes_to_str=True), f)
+        with open(export_path, "wb") as f:
+            f.write(orjson.dumps(message.to_dict(serialize_datetimes_to_str=True)))
 
     def get_message(self, entry_name):
         try:
-            with open(f"{self.cache_dir}/{entry_name}.json") as f:
-                return Message.from_dict(json.load(f))
+            with open(f"{self.cache_dir}/{entry_name}.json", "rb") as f:
+                return Message.from_dict(orjson.loads(f.read()))
         except FileNotFoundError:
             return None
 
@@ -78,9 +78,9 @@ class Cache:
         previous_export_file_path = path.join(f"{self.cache_dir}/{entry_name}.jsonl")
         messages = []
         try:
-            with open(previous_export_file_path) as f:
+            with open(previous_export_file_path, "rb") as f:
                 for line in f:
-                    messages.append(Message.from_dict(json.loads(line)))
+                    messages.append(Message.from_dict(orjson.loads(line)))
         except FileNotFoundError:
             return None
 
@@ -89,9 +89,8 @@ class Cache:
     def set_messages(self, entry_name, messages):
         export_file_path = path.join(f"{self.cache_dir}/{entry_name}.jsonl")
         IOUtils.ensure_dirs_exist_for_file(export_file_path)
-        with open(export_file_path, "w") as f:
-            for msg in messages:
-                f.write(f"{json.dumps(msg.to_dict(serialize_datetimes_to_str=True))}\n")
+        with open(export_file_path, "wb") as f:
+            f.writelines(orjson.dumps(msg.to_dict(serialize_datetimes_to_str=True)) + b"\n" for msg in messages)
 
     def _delete_file(self, filename):
         filepath = f"{self.cache_dir}/{filename}"
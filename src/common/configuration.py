@@ -1,6 +1,7 @@
-import json
 from dataclasses import dataclass
+from functools import lru_cache
 
+import orjson
 from coda_v2_python_client.firebase_client_wrapper import CodaV2Client
 from core_data_modules.logging import Logger
 from engagement_database import EngagementDatabase
@@ -11,7 +12,31 @@ from storage.google_cloud import google_cloud_utils
 log = Logger(__name__)
 
 
+@lru_cache(maxsize=None)
+def _load_credentials(google_cloud_credentials_file_path, credentials_file_url):
+    """
+    Downloads and parses a JSON credentials file from Google Cloud Storage.
+
+    Results are memoized by (google_cloud_credentials_file_path, credentials_file_url), so clients that share the
+    same credentials file only download and parse it once per run.
+
+    :param google_cloud_credentials_file_path: Path to the Google Cloud service account credentials file to use to
+                                               access the credentials bucket.
+    :type google_cloud_credentials_file_path: str
+    :param credentials_file_url: GS URL to the credentials file to download.
+    :type credentials_file_url: str
+    :return: Parsed credentials.
+    :rtype: dict
+    """
+    return orjson.loads(google_cloud_utils.download_blob_to_string(
+        google_cloud_credentials_file_path,
+        credentials_file_url
+    ))
+
+
 class EngagementDatabaseClientConfiguration:
+    __slots__ = ("credentials_file_url", "database_path")
+
     def __init__(self, credentials_file_url, database_path):
         """
         Configuration for creating an EngagementDatabase client.
@@ -35,10 +60,7 @@ class EngagementDatabaseClientConfiguration:
         :rtype: engagement_database.EngagementDatabase
         """
         log.info("Initialising engagement database client...")
-        credentials = json.loads(google_cloud_utils.download_blob_to_string(
-            google_cloud_credentials_file_path,
-            self.credentials_file_url
-        ))
+        credentials = _load_credentials(google_cloud_credentials_file_path, self.credentials_file_url)
 
         engagement_db = EngagementDatabase.init_from_credentials(
             credentials,
@@ -50,6 +72,8 @@ class EngagementDatabaseClientConfiguration:
 
 
 class UUIDTableClientConfiguration:
+    __slots__ = ("credentials_file_url", "table_name", "uuid_prefix")
+
     def __init__(self, credentials_file_url, table_name, uuid_prefix):
         """
         Configuration for creating a FirestoreUuidTable client.
@@ -75,10 +99,7 @@ class UUIDTableClientConfiguration:
         :rtype: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
         """
         log.info("Initialising uuid table client...")
-        credentials = json.loads(google_cloud_utils.download_blob_to_string(
-            google_cloud_credentials_file_path,
-            self.credentials_file_url
-        ))
+        credentials = _load_credentials(google_cloud_credentials_file_path, self.credentials_file_url)
 
         uuid_table = FirestoreUuidTable.init_from_credentials(
             credentials,
@@ -91,6 +112,8 @@ class UUIDTableClientConfiguration:
 
 
 class RapidProClientConfiguration:
+    __slots__ = ("domain", "token_file_url")
+
     def __init__(self, domain, token_file_url):
         """
         Configuration for creating a RapidProClient.
@@ -122,6 +145,8 @@ class RapidProClientConfiguration:
 
 
 class CodaClientConfiguration:
+    __slots__ = ("credentials_file_url",)
+
     def __init__(self, credentials_file_url):
         """
         Configuration for creating a CodaV2Client.
@@ -141,10 +166,7 @@ class CodaClientConfiguration:
         :rtype: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
         """
         log.info("Initialising Coda client...")
-        credentials = json.loads(google_cloud_utils.download_blob_to_string(
-            google_cloud_credentials_file_path,
-            self.credentials_file_url
-        ))
+        credentials = _load_credentials(google_cloud_credentials_file_path, self.credentials_file_url)
 
         coda = CodaV2Client.init_client(credentials)
         log.info("Initialised Coda client")
@@ -154,11 +176,15 @@ class CodaClientConfiguration:
 
 @dataclass
 class ArchiveConfiguration:
+    __slots__ = ("archive_upload_bucket", "bucket_dir_path")
+
     archive_upload_bucket: str
     bucket_dir_path: str
 
 @dataclass
 class OperationsDashboardConfiguration:
+    __slots__ = ("credentials_file_url",)
+
     credentials_file_url: str
 
 
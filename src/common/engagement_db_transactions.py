@@ -0,0 +1,144 @@
+import time
+
+from core_data_modules.logging import Logger
+from google.api_core.exceptions import Aborted
+from google.cloud import firestore
+from google.cloud.firestore_v1 import FieldFilter
+
+from src.common.get_messages_in_datasets import _chunk, _FIRESTORE_MAX_DISJUNCTIONS
+
+log = Logger(__name__)
+
+# Maximum number of times to attempt an engagement db transaction that keeps being aborted due to contention.
+_MAX_TRANSACTION_ATTEMPTS = 5
+
+# Seconds to wait before retrying an aborted engagement db transaction for the first time. This doubles on each retry.
+_INITIAL_TRANSACTION_RETRY_DELAY_SECONDS = 0.5
+
+
+def _is_aborted_transaction_error(e):
+    """
+    :param e: Exception raised by a `@firestore.transactional` function.
+    :type e: Exception
+    :return: Whether `e` was caused by the transaction being aborted due to contention.
+    :rtype: bool
+    """
+    # Reads that are aborted raise `Aborted` directly. Aborted commits are retried by `@firestore.transactional`, which
+    # raises a ValueError caused by the last `Aborted` once its own attempts are exhausted.
+    return isinstance(e, Aborted) or (isinstance(e, ValueError) and isinstance(e.__cause__, Aborted))
+
+
+def run_in_engagement_db_transaction(engagement_db, transactional_func, *args):
+    """
+    Runs a `@firestore.transactional` function in a new engagement db transaction, retrying with exponential backoff
+    if the transaction is aborted due to contention.
+
+    `@firestore.transactional` retries aborted commits itself, without waiting between attempts, and then gives up by
+    raising a ValueError. This backs off and retries in a new transaction when that happens, so that concurrent syncs
+    contending for the same documents have a chance to finish.
+
+    Every retry, including the ones made by `@firestore.transactional`, runs `transactional_func` again from the start.
+    Any side effects it has outside of the transaction (e.g. writes to Coda) are therefore replayed, so these must be
+    safe to repeat.
+
+    :param engagement_db: Engagement database to create the transaction in.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param transactional_func: `@firestore.transactional` function to run. This is called with a new transaction
+                               followed by `args`.
+    :type transactional_func: function
+    :param args: Arguments to pass to `transactional_func` after the transaction.
+    :return: The return value of `transactional_func`.
+    """
+    for attempt in range(1, _MAX_TRANSACTION_ATTEMPTS + 1):
+        try:
+            return transactional_func(engagement_db.transaction(), *args)
+        except (Aborted, ValueError) as e:
+            if not _is_aborted_transaction_error(e) or attempt == _MAX_TRANSACTION_ATTEMPTS:
+                raise e
+            retry_delay = _INITIAL_TRANSACTION_RETRY_DELAY_SECONDS * 2 ** (attempt - 1)
+            log.warning(f"Engagement db transaction aborted on attempt {attempt}/{_MAX_TRANSACTION_ATTEMPTS} ({e}), "
+                        f"retrying in {retry_delay} seconds...")
+            time.sleep(retry_delay)
+
+
+@firestore.transactional
+def _set_messages_in_transaction(transaction, engagement_db, messages_and_origins, expected_last_updated=None):
+    """
+    Sets a batch of messages in an engagement database, in a single transaction.
+
+    :param transaction: Transaction in the engagement database to perform the writes in.
+    :type transaction: google.cloud.firestore.Transaction
+    :param engagement_db: Engagement database to write to.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param messages_and_origins: Messages to write, with the HistoryEntryOrigin to record for each write.
+    :type messages_and_origins: list of (engagement_database.data_models.Message,
+                                engagement_database.data_models.HistoryEntryOrigin)
+    :param expected_last_updated: Dictionary of message_id -> the last_updated each message had when it was read, or
+                                  None. If provided, the messages are read again in the transaction and any message
+                                  whose last_updated no longer matches (or which no longer exists) isn't written, so
+                                  that changes made since the message was read aren't overwritten.
+    :type expected_last_updated: (dict of str -> datetime.datetime) | None
+    :return: Ids of the messages that weren't written because they had changed since they were read.
+    :rtype: set of str
+    """
+    changed_message_ids = set()
+    if expected_last_updated is not None:
+        latest_last_updated = dict()  # of message_id -> last_updated in the database
+        for message_ids in _chunk(list(expected_last_updated.keys()), _FIRESTORE_MAX_DISJUNCTIONS):
+            latest_messages = engagement_db.get_messages(
+                firestore_query_filter=lambda q: q.where(filter=FieldFilter("message_id", "in", message_ids)),
+                transaction=transaction
+            )
+            for latest_message in latest_messages:
+                latest_last_updated[latest_message.message_id] = latest_message.last_updated
+
+        changed_message_ids = {
+            message_id for message_id, last_updated in expected_last_updated.items()
+            if latest_last_updated.get(message_id) != last_updated
+        }
+
+    for message, origin in messages_and_origins:
+        if message.message_id in changed_message_ids:
+            continue
+        engagement_db.set_message(message, origin, transaction=transaction)
+
+    return changed_message_ids
+
+
+def write_messages_to_engagement_db(engagement_db, pending_writes, dry_run=False, skip_changed_messages=False):
+    """
+    Writes all the pending messages to an engagement database in a single transaction, then clears `pending_writes`.
+
+    Each message set writes both the message and a history entry, so `pending_writes` must contain at most 250
+    messages to stay within Firestore's 500-write limit.
+
+    :param engagement_db: Engagement database to write to.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param pending_writes: Messages to write, with the HistoryEntryOrigin to record for each write.
+    :type pending_writes: list of (engagement_database.data_models.Message,
+                          engagement_database.data_models.HistoryEntryOrigin)
+    :param dry_run: Whether to perform a dry run.
+    :type dry_run: bool
+    :param skip_changed_messages: Whether to read the messages again in the write transaction and skip any that have
+                                  changed in the database since they were read. Use this when `pending_writes` are
+                                  updates to existing messages, so that concurrent changes aren't overwritten.
+    :type skip_changed_messages: bool
+    """
+    if len(pending_writes) == 0:
+        return
+
+    # Take the expected last_updated timestamps before writing, because each attempt at the transaction may update
+    # the messages' last_updated as it sets them.
+    expected_last_updated = None
+    if skip_changed_messages:
+        expected_last_updated = {message.message_id: message.last_updated for message, _ in pending_writes}
+
+    log.info(f"Writing {len(pending_writes)} messages to the engagement database...")
+    if not dry_run:
+        changed_message_ids = run_in_engagement_db_transaction(
+            engagement_db, _set_messages_in_transaction, engagement_db, pending_writes, expected_last_updated
+        )
+        if len(changed_message_ids) > 0:
+            log.info(f"Skipped writing {len(changed_message_ids)} messages that have changed since they were read; "
+                     f"these will be synced again from their new last_updated")
+    pending_writes.clear()
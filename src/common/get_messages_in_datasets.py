@@ -1,4 +1,6 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 from core_data_modules.logging import Logger
 from engagement_database.data_models import MessageStatuses
@@ -6,6 +8,17 @@ from google.cloud.firestore_v1 import FieldFilter
 
 log = Logger(__name__)
 
+# Maximum number of values Firestore allows in a single 'in' / 'array_contains_any' filter.
+_FIRESTORE_MAX_DISJUNCTIONS = 30
+
+# Maximum number of Firestore queries to run concurrently.
+_MAX_CONCURRENT_QUERIES = 8
+
+# Maximum difference between the earliest and latest timestamps of the datasets in a single incremental query.
+# Each query downloads everything after the earliest timestamp in it, so datasets are only queried together when
+# their timestamps are this close; a dataset whose timestamp is far from all the others is queried on its own.
+_MAX_CHUNK_TIMESTAMP_SPAN = timedelta(hours=1)
+
 
 def filter_latest_message_snapshots(messages):
     """
@@ -13,18 +26,168 @@ def filter_latest_message_snapshots(messages):
 
     :param messages: List of messages to filter for the latest versions of each message.
     :type messages: list of engagement_database.data_models.Message
-    :return: Filtered messages.
+    :return: Filtered messages, sorted by last_updated, newest first.
     :rtype: list of engagement_database.data_models.Message
     """
-    latest_messages = []
-    seen_message_ids = set()
-    messages.sort(key=lambda msg: msg.last_updated, reverse=True)
-    for msg in messages:
-        if msg.message_id not in seen_message_ids:
-            seen_message_ids.add(msg.message_id)
-            latest_messages.append(msg)
+    # Most message_ids only have one snapshot, so use setdefault to insert those with a single dict operation, and
+    # only compare timestamps when a message_id has already been seen.
+    latest_message_indices = dict()  # of message_id -> index in `messages` of the latest snapshot seen so far
+    for i, msg in enumerate(messages):
+        latest_i = latest_message_indices.setdefault(msg.message_id, i)
+        if latest_i != i and msg.last_updated > messages[latest_i].last_updated:
+            latest_message_indices[msg.message_id] = i
+
+    # Return the messages newest first, breaking ties by their position in `messages`. Downstream outputs
+    # (e.g. concatenated message texts and the analysis files) depend on this order.
+    # (Python's sort is stable, including with reverse=True, so sorting the indices first gives the tie-break).
+    latest_indices = sorted(latest_message_indices.values())
+    latest_indices.sort(key=lambda i: messages[i].last_updated, reverse=True)
+    return [messages[i] for i in latest_indices]
+
+
+def _chunk(items, chunk_size):
+    """
+    Splits a list into consecutive chunks of at most `chunk_size` items.
+
+    :param items: Items to split.
+    :type items: list
+    :param chunk_size: Maximum number of items in each chunk.
+    :type chunk_size: int
+    :return: Chunks of `items`.
+    :rtype: list of list
+    """
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def _chunk_by_timestamp(dataset_to_timestamp):
+    """
+    Splits datasets into chunks that can be incrementally queried together.
+
+    Each chunk contains at most `_FIRESTORE_MAX_DISJUNCTIONS` datasets, whose timestamps are all within
+    `_MAX_CHUNK_TIMESTAMP_SPAN` of each other.
+
+    :param dataset_to_timestamp: Dictionary of engagement db dataset -> timestamp to download updates after.
+    :type dataset_to_timestamp: dict of str -> datetime.datetime
+    :return: Chunks of datasets.
+    :rtype: list of list of str
+    """
+    chunks = []
+    chunk_start_timestamp = None
+    for dataset in sorted(dataset_to_timestamp, key=lambda dataset: dataset_to_timestamp[dataset]):
+        timestamp = dataset_to_timestamp[dataset]
+        if len(chunks) == 0 or len(chunks[-1]) == _FIRESTORE_MAX_DISJUNCTIONS or \
+                timestamp - chunk_start_timestamp > _MAX_CHUNK_TIMESTAMP_SPAN:
+            chunks.append([])
+            chunk_start_timestamp = timestamp
+        chunks[-1].append(dataset)
+
+    return chunks
+
+
+def _get_updated_messages_in_datasets(engagement_db, dataset_to_latest_timestamp):
+    """
+    Downloads the messages in each dataset that were updated after that dataset's latest timestamp.
+
+    Datasets with close timestamps are queried in chunks using Firestore 'in' filters, and the chunks are downloaded
+    concurrently. Each chunk query uses the earliest timestamp in the chunk, so messages older than their own dataset's
+    timestamp are discarded after download.
+
+    :param engagement_db: Engagement database to fetch messages from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param dataset_to_latest_timestamp: Dictionary of engagement db dataset -> timestamp to download updates after.
+    :type dataset_to_latest_timestamp: dict of str -> datetime.datetime
+    :return: Dictionary of engagement db dataset -> list of updated Messages in dataset.
+    :rtype: dict of str -> list of engagement_database.data_models.Message
+    """
+    def download_chunk(datasets):
+        min_timestamp = min(dataset_to_latest_timestamp[dataset] for dataset in datasets)
+        updated_messages_filter = lambda q: q \
+            .where(filter=FieldFilter("dataset", "in", datasets)) \
+            .where(filter=FieldFilter("last_updated", ">", min_timestamp))
+
+        return engagement_db.get_messages(firestore_query_filter=updated_messages_filter, batch_size=500)
+
+    dataset_to_updated_messages = {dataset: [] for dataset in dataset_to_latest_timestamp}
+    chunks = _chunk_by_timestamp(dataset_to_latest_timestamp)
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_QUERIES) as executor:
+        for messages in executor.map(download_chunk, chunks):
+            for msg in messages:
+                if msg.last_updated > dataset_to_latest_timestamp[msg.dataset]:
+                    dataset_to_updated_messages[msg.dataset].append(msg)
+
+    return dataset_to_updated_messages
+
+
+def _get_ws_corrected_messages_in_datasets(engagement_db, dataset_to_latest_ws_timestamp):
+    """
+    Downloads the messages that used to be in each dataset and were updated after that dataset's latest ws timestamp.
+
+    Datasets are queried in chunks using Firestore 'array_contains_any' filters on `previous_datasets`, and the chunks
+    are downloaded concurrently. Only datasets with close ws timestamps are queried together. Each chunk query uses the
+    earliest timestamp in the chunk, so downloaded messages are only assigned to the datasets in their
+    `previous_datasets` whose own ws timestamp they are newer than.
+
+    :param engagement_db: Engagement database to fetch messages from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param dataset_to_latest_ws_timestamp: Dictionary of engagement db dataset -> timestamp to download ws corrected
+                                           messages after.
+    :type dataset_to_latest_ws_timestamp: dict of str -> datetime.datetime
+    :return: Dictionary of engagement db dataset -> list of Messages that have this dataset in `previous_datasets`.
+    :rtype: dict of str -> list of engagement_database.data_models.Message
+    """
+    def download_chunk(datasets):
+        min_timestamp = min(dataset_to_latest_ws_timestamp[dataset] for dataset in datasets)
+        ws_corrected_messages_filter = lambda q: q \
+            .where(filter=FieldFilter("previous_datasets", "array_contains_any", datasets)) \
+            .where(filter=FieldFilter("last_updated", ">", min_timestamp))
+
+        return engagement_db.get_messages(firestore_query_filter=ws_corrected_messages_filter, batch_size=500)
+
+    dataset_to_ws_corrected_messages = {dataset: [] for dataset in dataset_to_latest_ws_timestamp}
+    chunks = _chunk_by_timestamp(dataset_to_latest_ws_timestamp)
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_QUERIES) as executor:
+        for messages in executor.map(download_chunk, chunks):
+            for msg in messages:
+                for dataset in set(msg.previous_datasets):
+                    if dataset in dataset_to_ws_corrected_messages and \
+                            msg.last_updated > dataset_to_latest_ws_timestamp[dataset]:
+                        dataset_to_ws_corrected_messages[dataset].append(msg)
+
+    return dataset_to_ws_corrected_messages
+
+
+def _get_all_messages_in_datasets(engagement_db, datasets):
+    """
+    Downloads all the live or stale messages in each of the given datasets.
+
+    Datasets are queried in chunks using Firestore 'in' filters, and the chunks are downloaded concurrently.
+    Firestore counts each (dataset, status) combination towards its disjunction limit, so chunks are sized to fit
+    that limit.
+
+    :param engagement_db: Engagement database to fetch messages from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param datasets: Datasets to download.
+    :type datasets: list of str
+    :return: Dictionary of engagement db dataset -> list of live or stale Messages in dataset.
+    :rtype: dict of str -> list of engagement_database.data_models.Message
+    """
+    statuses = [MessageStatuses.LIVE, MessageStatuses.STALE]
+
+    def download_chunk(datasets_chunk):
+        full_download_filter = lambda q: q \
+            .where(filter=FieldFilter("dataset", "in", datasets_chunk)) \
+            .where(filter=FieldFilter("status", "in", statuses))
 
-    return latest_messages
+        return engagement_db.get_messages(firestore_query_filter=full_download_filter, batch_size=500)
+
+    dataset_to_messages = {dataset: [] for dataset in datasets}
+    chunks = _chunk(datasets, _FIRESTORE_MAX_DISJUNCTIONS // len(statuses))
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_QUERIES) as executor:
+        for messages in executor.map(download_chunk, chunks):
+            for msg in messages:
+                dataset_to_messages[msg.dataset].append(msg)
+
+    return dataset_to_messages
 
 
 def get_messages_in_datasets(engagement_db, engagement_db_datasets, cache=None, dry_run=False):
@@ -46,32 +209,57 @@ def get_messages_in_datasets(engagement_db, engagement_db_datasets, cache=None,
     """
     engagement_db_messages_map = dict()  # of engagement db dataset -> list of Message
 
+    # De-duplicate the requested datasets, so each dataset is only queried and cached once.
+    engagement_db_datasets = list(dict.fromkeys(engagement_db_datasets))
+    dataset_to_latest_timestamp = dict()  # of engagement db dataset -> datetime of latest cached message
+    if cache is not None:
+        for engagement_db_dataset in engagement_db_datasets:
+            latest_message_timestamp = cache.get_date_time(engagement_db_dataset)
+            if latest_message_timestamp is not None:
+                dataset_to_latest_timestamp[engagement_db_dataset] = latest_message_timestamp
+
+    # Download messages that have been updated/created after the previous run, for all the datasets that can be
+    # incrementally downloaded at once.
+    if len(dataset_to_latest_timestamp) > 0:
+        log.info(f"Downloading updated messages for {len(dataset_to_latest_timestamp)} incrementally cached "
+                 f"dataset(s)...")
+    dataset_to_updated_messages = _get_updated_messages_in_datasets(engagement_db, dataset_to_latest_timestamp)
+
+    # Download messages that used to be in each incrementally cached dataset, and were ws corrected away after the
+    # previous run.
+    dataset_to_latest_ws_timestamp = {
+        engagement_db_dataset: cache.get_date_time(f"{engagement_db_dataset}_ws")
+        for engagement_db_dataset in dataset_to_latest_timestamp
+    }
+    dataset_to_downloaded_ws_corrected_messages = _get_ws_corrected_messages_in_datasets(
+        engagement_db, dataset_to_latest_ws_timestamp
+    )
+
+    # Download all the messages in the datasets that aren't in the cache yet.
+    full_download_datasets = [dataset for dataset in engagement_db_datasets
+                              if dataset not in dataset_to_latest_timestamp]
+    if len(full_download_datasets) > 0:
+        log.warning(f"Performing a full download for {len(full_download_datasets)} dataset(s)...")
+    dataset_to_full_download_messages = _get_all_messages_in_datasets(engagement_db, full_download_datasets)
+
     for engagement_db_dataset in engagement_db_datasets:
         messages = []
-        latest_message_timestamp = None if cache is None else cache.get_date_time(engagement_db_dataset)
+        # Whether the messages differ from the cached messages, which have already been filtered for their latest
+        # snapshots.
+        messages_changed = True
+        latest_message_timestamp = dataset_to_latest_timestamp.get(engagement_db_dataset)
         full_download_required = latest_message_timestamp is None
         if not full_download_required:
             log.info(f"Performing incremental download for {engagement_db_dataset} messages...")
 
-            # Download messages that have been updated/created after the previous run
-            incremental_messages_filter = lambda q: q \
-                .where(filter=FieldFilter("dataset", "==", engagement_db_dataset)) \
-                .where(filter=FieldFilter("last_updated", ">", latest_message_timestamp))
-
-            updated_messages = engagement_db.get_messages(
-                firestore_query_filter=incremental_messages_filter, batch_size=500)
+            updated_messages = dataset_to_updated_messages[engagement_db_dataset]
             messages.extend(updated_messages)
 
             # Check and remove cached messages that have been ws corrected away from this dataset after the previous
             # run. We do this by searching for all messages that used to be in this dataset, that we haven't
             # already seen.
-            latest_ws_message_timestamp = cache.get_date_time(f"{engagement_db_dataset}_ws")
-            ws_corrected_messages_filter = lambda q: q \
-                .where(filter=FieldFilter("previous_datasets", "array_contains", engagement_db_dataset)) \
-                .where(filter=FieldFilter("last_updated", ">", latest_ws_message_timestamp))
-
-            downloaded_ws_corrected_messages = engagement_db.get_messages(
-                firestore_query_filter=ws_corrected_messages_filter, batch_size=500)
+            latest_ws_message_timestamp = dataset_to_latest_ws_timestamp[engagement_db_dataset]
+            downloaded_ws_corrected_messages = dataset_to_downloaded_ws_corrected_messages[engagement_db_dataset]
 
             # Filter ws_corrected_messages whose dataset == the engagement_db_dataset.
             # This prevents messages that have the current dataset in their previous_datasets from being erroneously
@@ -93,26 +281,29 @@ def get_messages_in_datasets(engagement_db, engagement_db_datasets, cache=None,
                     cache.set_date_time(f"{engagement_db_dataset}_ws", latest_ws_message_timestamp)
 
             cache_messages = cache.get_messages(engagement_db_dataset)
+            ws_corrected_message_ids = {msg.message_id for msg in ws_corrected_messages}
             for msg in cache_messages:
-                if msg.message_id in {msg.message_id for msg in ws_corrected_messages}:
+                if msg.message_id in ws_corrected_message_ids:
                     continue
                 messages.append(msg)
+
+            messages_changed = len(updated_messages) > 0 or len(ws_corrected_messages) > 0
         else:
             log.warning(f"Performing a full download for {engagement_db_dataset} messages...")
 
-            full_download_filter = lambda q: q \
-                .where(filter=FieldFilter("dataset", "==", engagement_db_dataset)) \
-                .where(filter=FieldFilter("status", "in", {MessageStatuses.LIVE, MessageStatuses.STALE}))
-
-            messages = engagement_db.get_messages(firestore_query_filter=full_download_filter, batch_size=500)
+            messages = dataset_to_full_download_messages[engagement_db_dataset]
             log.info(f"Downloaded {len(messages)} messages")
 
         # Filter messages for their latest versions in this dataset.
         # Filtering within a dataset keeps the cache small and fast.
-        latest_messages = filter_latest_message_snapshots(messages)
-        log.info(f"Filtered for latest message snapshots in dataset {engagement_db_dataset}: "
-                 f"{len(latest_messages)}/{len(messages)} snapshots remain")
-        messages = latest_messages
+        if messages_changed:
+            latest_messages = filter_latest_message_snapshots(messages)
+            log.info(f"Filtered for latest message snapshots in dataset {engagement_db_dataset}: "
+                     f"{len(latest_messages)}/{len(messages)} snapshots remain")
+            messages = latest_messages
+        else:
+            log.info(f"No changes to dataset {engagement_db_dataset} since the previous run; using the "
+                     f"{len(messages)} cached latest message snapshots")
 
         engagement_db_messages_map[engagement_db_dataset] = messages
 
@@ -133,7 +324,7 @@ def get_messages_in_datasets(engagement_db, engagement_db_datasets, cache=None,
                 cache.set_date_time(f"{engagement_db_dataset}_ws", latest_message_timestamp)
 
             # Export project engagement_dataset files
-            if len(messages) > 0:
+            if messages_changed and len(messages) > 0:
                 cache.set_messages(engagement_db_dataset, messages)
 
     # Filter messages for their latest versions across all datasets.
@@ -157,36 +348,42 @@ def get_messages_in_datasets(engagement_db, engagement_db_datasets, cache=None,
     # Ensure that origin_ids in the exported messages are all unique. If we have multiple messages with the same
     # origin_id, that means there is a problem with the database or with the cache.
     # (Most likely we added the same message twice or we deleted a message and forgot to delete the analysis cache).
-    all_message_origins = set()
+    origin_ids = []
     for messages in engagement_db_messages_map.values():
         for msg in messages:
             origin_id = msg.origin.origin_id
-            if type(origin_id) == list:
+            if isinstance(origin_id, list):
                 origin_id = tuple(origin_id)
+            origin_ids.append(origin_id)
 
-            assert origin_id not in all_message_origins, f"Multiple messages had the same origin id: " \
-                                                         f"'{msg.origin.origin_id}'"
-            all_message_origins.add(origin_id)
+    origin_id_counts = Counter(origin_ids)
+    duplicate_origin_ids = [origin_id for origin_id, count in origin_id_counts.items() if count > 1]
+    assert len(duplicate_origin_ids) == 0, f"Multiple messages had the same origin ids: {duplicate_origin_ids}"
 
     # Filter out messages that don't meet the status conditions
     for engagement_db_dataset, messages in engagement_db_messages_map.items():
-        # Find the messages that have status "live" or "stale"
-        live_messages = [msg for msg in messages if msg.status == MessageStatuses.LIVE]
-        stale_messages = [msg for msg in messages if msg.status == MessageStatuses.STALE]
+        # Find the messages that have status "live" or "stale", and the participants who have live messages
+        live_messages = []
+        stale_messages = []
+        live_participants = set()
+        for msg in messages:
+            if msg.status == MessageStatuses.LIVE:
+                live_messages.append(msg)
+                live_participants.add(msg.participant_uuid)
+            elif msg.status == MessageStatuses.STALE:
+                stale_messages.append(msg)
         log.info(f"Filtered {engagement_db_dataset} for live/stale messages: "
                  f"{len(live_messages) + len(stale_messages)}/{len(messages)} messages remain "
                  f"({len(live_messages)} live and {len(stale_messages)} stale)")
 
         # Find the active messages - that is, those that are live, and those that are stale where there is no
         # live message from this participant in this dataset
-        live_participants = {msg.participant_uuid for msg in live_messages}
-        active_messages = list(live_messages)
-        for msg in stale_messages:
-            if msg.participant_uuid not in live_participants:
-                active_messages.append(msg)
+        active_messages = live_messages + [
+            msg for msg in stale_messages if msg.participant_uuid not in live_participants
+        ]
 
         log.info(f"Filtered {engagement_db_dataset} to exclude stale messages from participants who have live "
-                 f"messages: {len(active_messages)}/{len(live_messages + stale_messages)} messages remain")
+                 f"messages: {len(active_messages)}/{len(live_messages) + len(stale_messages)} messages remain")
 
         engagement_db_messages_map[engagement_db_dataset] = active_messages
 
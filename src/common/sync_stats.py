@@ -1,23 +1,23 @@
 import abc
 from abc import ABC
+from collections import Counter
 
 
 class SyncStats(ABC):
     def __init__(self, initial_event_counts):
-        self.event_counts = initial_event_counts
+        self.event_counts = Counter(initial_event_counts)
 
     def add_event(self, event):
-        if event not in self.event_counts:
-            self.event_counts[event] = 0
-        self.event_counts[event] += 1
+        self.add_event_count(event, 1)
+
+    def add_event_count(self, event, count):
+        self.event_counts[event] += count
 
     def add_events(self, events):
-        for event in events:
-            self.add_event(event)
+        self.event_counts.update(events)
 
     def add_stats(self, stats):
-        for k, v in stats.event_counts.items():
-            self.event_counts[k] += v
+        self.event_counts.update(stats.event_counts)
 
     @abc.abstractmethod
     def print_summary(self):
@@ -7,6 +7,8 @@ _MAX_DATE_UTC = pytz.timezone("utc").localize(datetime.max)
 
 
 class CSVDatasetConfiguration:
+    __slots__ = ("engagement_db_dataset", "start_date", "end_date")
+
     def __init__(self, engagement_db_dataset, start_date=_MIN_DATE_UTC, end_date=_MAX_DATE_UTC):
         """
         Configuration for an engagement db dataset to sync csv messages to.
@@ -34,7 +36,9 @@ class CSVDatasetConfiguration:
 
 
 class CSVSource:
-    def __init__(self, gs_url, engagement_db_datasets, timezone):
+    __slots__ = ("gs_url", "engagement_db_datasets", "timezone", "skip_duplicate_rows")
+
+    def __init__(self, gs_url, engagement_db_datasets, timezone, skip_duplicate_rows=False):
         """
         Configuration for a CSV data source. The CSV should have the headings 'Sender', 'Message', and 'ReceivedOn'.
 
@@ -44,10 +48,14 @@ class CSVSource:
         :type engagement_db_datasets: list of CSVDatasetConfiguration
         :param timezone: Timezone to interpret the csv's timestamps in e.g. 'Africa/Nairobi'.
         :type timezone: str
+        :param skip_duplicate_rows: Whether to only sync the first of any rows in this csv that have the same
+                                    'Sender', 'Message', and 'ReceivedOn'.
+        :type skip_duplicate_rows: bool
         """
         self.gs_url = gs_url
         self.engagement_db_datasets = engagement_db_datasets
         self.timezone = timezone
+        self.skip_duplicate_rows = skip_duplicate_rows
 
     def get_dataset_for_timestamp(self, timestamp):
         """
@@ -85,5 +93,6 @@ class CSVSource:
         return {
             "gs_url": self.gs_url,
             "engagement_db_datasets": serialized_engagement_db_datasets,
-            "timezone": self.timezone
+            "timezone": self.timezone,
+            "skip_duplicate_rows": self.skip_duplicate_rows
         }
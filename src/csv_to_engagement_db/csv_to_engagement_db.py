@@ -1,47 +1,299 @@
 import csv
+import hashlib
+import io
+import re
+import tempfile
+import threading
 import urllib.parse
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
-from io import StringIO
+from functools import lru_cache
 
 import pytz
 from core_data_modules.cleaners import URNCleaner
 from core_data_modules.logging import Logger
-from core_data_modules.util import SHAUtils
 from engagement_database.data_models import (HistoryEntryOrigin, Message, MessageDirections, MessageOrigin,
                                              MessageStatuses)
 from google.cloud.firestore_v1 import FieldFilter
 
 from src.common.cache import Cache
+from src.common.engagement_db_transactions import write_messages_to_engagement_db
 from src.csv_to_engagement_db.sync_stats import CSVSyncEvents, CSVToEngagementDBDatasetSyncStats, CSVToEngagementDBSyncStats
 from storage.google_cloud import google_cloud_utils
 
 log = Logger(__name__)
 
+# Maximum number of csvs to sync concurrently.
+_MAX_CONCURRENT_CSV_SYNCS = 8
 
-def _parse_date_string(date_string, timezone):
+# Maximum number of messages to write to the engagement database per transaction. Each message set writes both the
+# message and a history entry, so this keeps each transaction within Firestore's 500-write batch limit.
+_MAX_MESSAGES_PER_WRITE_BATCH = 250
+
+# Number of bytes to read at a time when re-hashing downloaded csvs.
+_FILE_READ_CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of parsed date strings to memoize per CSV.
+_MAX_CACHED_DATE_STRINGS = 4096
+
+# All the variants we've seen for expressing timestamps in CSVs.
+_DATE_FORMATS = ["%d/%m/%Y %H:%M", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M:%S.%f", "%Y/%m/%d %H:%M:%S.%f",
+                 "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S"]
+
+# Regexes matching the zero-padded forms of `_DATE_FORMATS`, which cover the timestamps in almost every CSV.
+# These extract the date fields in a single pass, avoiding `strptime`'s per-call format handling and the exceptions
+# raised by trying each format in turn. Each regex is paired with the order of its (year, month, day) groups.
+_DATE_REGEXES = [
+    # %d/%m/%Y %H:%M, %d/%m/%Y %H:%M:%S, and %d/%m/%Y %H:%M:%S.%f
+    (re.compile(r"([0-9]{2})/([0-9]{2})/([0-9]{4}) ([0-9]{2}):([0-9]{2})(?::([0-9]{2})(?:\.([0-9]{1,6}))?)?"),
+     (2, 1, 0)),
+    # %Y/%m/%d %H:%M:%S and %Y/%m/%d %H:%M:%S.%f
+    (re.compile(r"([0-9]{4})/([0-9]{2})/([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?"), (0, 1, 2)),
+    # %Y-%m-%d %H:%M:%S
+    (re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})()"), (0, 1, 2))
+]
+
+
+def _parse_raw_date_string_with_regexes(date_string):
     """
+    Parses a date string written in the zero-padded form of one of the `_DATE_FORMATS`, using `_DATE_REGEXES`.
+
     :param date_string: Date string to parse.
     :type date_string: str
-    :param timezone: Timezone to interpret the date_string in, e.g. 'Africa/Nairobi'.
-    :type timezone: str
-    :return: Parsed datetime, in the given timezone.
-    :rtype: datetime.datetime
+    :return: Parsed, timezone-naive datetime, or None if `date_string` isn't in one of the supported forms.
+    :rtype: datetime.datetime | None
     """
-    # Try parsing using a list of all the variants we've seen for expressing timestamps.
-    for date_format in ["%d/%m/%Y %H:%M", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M:%S.%f", "%Y/%m/%d %H:%M:%S.%f",
-                        "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S"]:
+    for regex, (year_group, month_group, day_group) in _DATE_REGEXES:
+        match = regex.fullmatch(date_string)
+        if match is None:
+            continue
+
+        groups = match.groups()
+        seconds = groups[5]
+        microseconds = groups[6]
         try:
-            parsed_raw_date = datetime.strptime(date_string, date_format)
-            break
+            return datetime(
+                int(groups[year_group]), int(groups[month_group]), int(groups[day_group]),
+                int(groups[3]), int(groups[4]), 0 if seconds is None else int(seconds),
+                # strptime's %f treats the digits as a fraction of a second, so right-pad to microseconds.
+                0 if not microseconds else int(microseconds.ljust(6, "0"))
+            )
         except ValueError:
-            pass
-    else:
-        raise ValueError(f"Could not parse date {date_string}")
-    return pytz.timezone(timezone).localize(parsed_raw_date)
+            # Out of range field values. Leave these for `strptime` to reject.
+            return None
+
+    return None
+
+
+def _make_date_parser(timezone):
+    """
+    Makes a function that parses date strings in the given timezone.
+
+    The returned parser first tries the precompiled `_DATE_REGEXES`. If none of those match, it falls back to
+    `strptime`, trying the most recently successful date format first, so a CSV whose timestamps are all written in
+    the same format only needs one `strptime` attempt per row. Results are memoized, so timestamps that repeat
+    within a CSV (e.g. minute-resolution timestamps) are only parsed once.
+
+    :param timezone: Timezone to interpret date strings in, e.g. 'Africa/Nairobi'.
+    :type timezone: str
+    :return: Function which parses a date string into a datetime in the given timezone.
+    :rtype: func of str -> datetime.datetime
+    """
+    tz = pytz.timezone(timezone)
+    last_format_index = 0
+
+    @lru_cache(maxsize=_MAX_CACHED_DATE_STRINGS)
+    def parse_date_string(date_string):
+        nonlocal last_format_index
+
+        parsed_raw_date = _parse_raw_date_string_with_regexes(date_string)
+        if parsed_raw_date is not None:
+            return tz.localize(parsed_raw_date)
+
+        format_indices = [last_format_index] + [i for i in range(len(_DATE_FORMATS)) if i != last_format_index]
+        for i in format_indices:
+            try:
+                parsed_raw_date = datetime.strptime(date_string, _DATE_FORMATS[i])
+                last_format_index = i
+                break
+            except ValueError:
+                pass
+        else:
+            raise ValueError(f"Could not parse date {date_string}")
+        return tz.localize(parsed_raw_date)
+
+    return parse_date_string
+
+
+def _sha_file(f):
+    """
+    Computes the SHA-256 hex digest of a binary file's contents, reading the file in chunks.
+
+    This matches `SHAUtils.sha_string` on the utf-8 decoded contents.
+
+    :param f: Binary file to hash. This is read from the beginning.
+    :type f: file-like
+    :return: SHA-256 hex digest of the file's contents.
+    :rtype: str
+    """
+    sha = hashlib.sha256()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(_FILE_READ_CHUNK_SIZE), b""):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+class _HashingFileWriter:
+    def __init__(self, f):
+        """
+        Wraps a binary file so that the SHA-256 of everything written to it is computed as it is written.
+
+        This lets us hash a downloaded file while it downloads, rather than re-reading it afterwards.
+
+        :param f: Binary file to write to.
+        :type f: file-like
+        """
+        self._f = f
+        self._sha = hashlib.sha256()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self._sha.update(data)
+        self.bytes_written += len(data)
+        return self._f.write(data)
+
+    def hexdigest(self):
+        return self._sha.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def _download_csv_to_file(google_cloud_credentials_file_path, gs_url, f):
+    """
+    Downloads a csv from Google Cloud Storage to a binary file, and computes its SHA-256 while downloading.
+
+    The hash matches `SHAUtils.sha_string` on the utf-8 decoded contents.
+
+    :param google_cloud_credentials_file_path: Path to the Google Cloud service account credentials file to use when
+                                               downloading the CSV.
+    :type google_cloud_credentials_file_path: str
+    :param gs_url: Google Cloud Storage URL to the csv file.
+    :type gs_url: str
+    :param f: Empty binary file to download to.
+    :type f: file-like
+    :return: SHA-256 hex digest of the downloaded csv.
+    :rtype: str
+    """
+    hashing_writer = _HashingFileWriter(f)
+    google_cloud_utils.download_blob_to_file(google_cloud_credentials_file_path, gs_url, hashing_writer)
+
+    # If the download restarted part way through (e.g. after seeking back on a retry), the bytes we hashed won't
+    # match the file's contents, so fall back to re-reading the downloaded file.
+    if hashing_writer.bytes_written != f.seek(0, io.SEEK_END):
+        log.warning(f"Hashed bytes did not match the downloaded size of '{gs_url}'; re-hashing the downloaded file")
+        return _sha_file(f)
+
+    return hashing_writer.hexdigest()
 
 
-def _csv_message_to_engagement_db_message(csv_message, uuid_table, origin_id, csv_source):
+@contextmanager
+def _open_csv_text(raw_csv_file):
+    """
+    Opens a downloaded csv file for reading as text, starting from the beginning of the file.
+
+    The file is left open on exit, so it can be read again.
+
+    :param raw_csv_file: Binary file containing a utf-8 encoded csv.
+    :type raw_csv_file: file-like
+    :return: Context manager yielding a text file suitable for passing to the `csv` module.
+    :rtype: contextlib.AbstractContextManager
+    """
+    raw_csv_file.seek(0)
+    text_file = io.TextIOWrapper(raw_csv_file, encoding="utf-8", newline="")
+    try:
+        yield text_file
+    finally:
+        # Detach so the text wrapper doesn't close raw_csv_file when it is garbage collected.
+        text_file.detach()
+
+
+def _read_csv_rows(raw_csv_file):
+    """
+    Reads the rows of a downloaded csv file lazily, starting from the beginning of the file.
+
+    The file is left open once all the rows have been read, so it can be read again.
+
+    :param raw_csv_file: Binary file containing a utf-8 encoded csv.
+    :type raw_csv_file: file-like
+    :return: Generator of the csv's rows, as dictionaries of header -> value.
+    :rtype: generator of dict
+    """
+    with _open_csv_text(raw_csv_file) as text_file:
+        yield from csv.DictReader(text_file)
+
+
+def _read_csv_column(raw_csv_file, column_name):
+    """
+    Reads a single column of a downloaded csv file lazily, starting from the beginning of the file.
+
+    This returns the same values as reading `row[column_name]` from each row of `_read_csv_rows`, but avoids building
+    a dictionary for every row.
+
+    :param raw_csv_file: Binary file containing a utf-8 encoded csv.
+    :type raw_csv_file: file-like
+    :param column_name: Header of the column to read.
+    :type column_name: str
+    :return: Generator of the values in the column. Values are None for rows that are too short to have this column.
+    :rtype: generator of (str | None)
+    """
+    with _open_csv_text(raw_csv_file) as text_file:
+        reader = csv.reader(text_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        # Match csv.DictReader, where the last of any repeated headers wins.
+        column_index = {name: i for i, name in enumerate(header)}.get(column_name)
+
+        for row in reader:
+            # csv.DictReader skips empty rows
+            if row == []:
+                continue
+            if column_index is None:
+                raise KeyError(column_name)
+            yield row[column_index] if column_index < len(row) else None
+
+
+def _get_participant_channel_operators(uuid_table, participant_uuids):
+    """
+    Gets the channel operator of each of the given participants.
+
+    The participants' urns are re-identified in a single batch, so each participant is only looked up once no matter
+    how many messages they sent.
+
+    :param uuid_table: UUID table to use to re-identify the URNs so we can set the channel operator.
+    :type uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+    :param participant_uuids: Participant uuids to get the channel operators of.
+    :type participant_uuids: set of str
+    :return: Dictionary of participant uuid -> channel operator.
+    :rtype: dict of str -> str
+    """
+    for participant_uuid in participant_uuids:
+        assert participant_uuid.startswith(uuid_table._uuid_prefix), f"Sender uuid does not start with uuid prefix " \
+                                                                     f"'{uuid_table._uuid_prefix}'"
+
+    log.info(f"Re-identifying {len(participant_uuids)} participant uuids...")
+    participant_uuid_to_urn = uuid_table.uuid_to_data_batch(participant_uuids)
+
+    return {
+        participant_uuid: URNCleaner.clean_operator(participant_urn)
+        for participant_uuid, participant_urn in participant_uuid_to_urn.items()
+    }
+
+
+def _csv_message_to_engagement_db_message(csv_message, participant_channel_operators, origin_id, csv_source,
+                                          parse_date_string):
     """
     Converts a CSV message to an engagement database message.
 
@@ -49,22 +301,23 @@ def _csv_message_to_engagement_db_message(csv_message, uuid_table, origin_id, cs
 
     :param csv_message: Dictionary containing the headers: 'Sender', 'Message', and 'ReceivedOn'.
     :type csv_message: dict
-    :param uuid_table: UUID table to use to re-identify the URNs so we can set the channel operator.
-    :type uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+    :param participant_channel_operators: Dictionary of participant uuid -> channel operator, for every sender in
+                                          the csv. Construct using `_get_participant_channel_operators`.
+    :type participant_channel_operators: dict of str -> str
     :param origin_id: Origin id, for the message origin field.
     :type origin_id: str
     :param csv_source:
     :type csv_source: src.csv_to_engagement_db.configuration.CSVSource
+    :param parse_date_string: Function to use to parse the 'ReceivedOn' timestamp, in the csv source's timezone.
+                              Construct using `_make_date_parser(csv_source.timezone)`.
+    :type parse_date_string: func of str -> datetime.datetime
     :return: `csv_message` as an engagement db message.
     :rtype: engagement_database.data_models.Message | None
     """
     participant_uuid = csv_message["Sender"]
-    assert participant_uuid.startswith(uuid_table._uuid_prefix), f"Sender uuid does not start with uuid prefix " \
-                                                                 f"'{uuid_table._uuid_prefix}'"
-    participant_urn = uuid_table.uuid_to_data(participant_uuid)
-    channel_operator = URNCleaner.clean_operator(participant_urn)
+    channel_operator = participant_channel_operators[participant_uuid]
 
-    timestamp = _parse_date_string(csv_message["ReceivedOn"], csv_source.timezone)
+    timestamp = parse_date_string(csv_message["ReceivedOn"])
 
     try:
         dataset = csv_source.get_dataset_for_timestamp(timestamp)
@@ -87,57 +340,91 @@ def _csv_message_to_engagement_db_message(csv_message, uuid_table, origin_id, cs
     )
 
 
-def _engagement_db_has_message(engagement_db, message):
+def _get_origin_ids_in_engagement_db(engagement_db, csv_hash):
     """
-    Checks if an engagement database contains a message with the same origin id as the given message.
+    Gets the origin ids of all the messages in an engagement database that were synced from the CSV with the given
+    hash.
+
+    All the messages synced from a CSV have origin ids of the form 'csv_{csv_hash}.row_{i}', so these can be fetched
+    in a single prefix query (expressed as a range on origin.origin_id) rather than by querying for each row's origin
+    id individually.
 
-    :param engagement_db: Engagement database to check for the message.
+    :param engagement_db: Engagement database to search.
     :type engagement_db: engagement_database.EngagementDatabase
-    :param message: Message to check for existence.
-    :type message: engagement_database.data_models.Message
-    :return: Whether a message with this text, timestamp, and participant_uuid exists in the engagement database.
-    :rtype: bool
+    :param csv_hash: SHA of the CSV to get the synced origin ids of.
+    :type csv_hash: str
+    :return: Origin ids of the messages in the engagement database that came from this CSV.
+    :rtype: set of str
     """
-    matching_messages_filter = lambda q: q.where(filter=FieldFilter("origin.origin_id", "==", message.origin.origin_id))
-    matching_messages = engagement_db.get_messages(firestore_query_filter=matching_messages_filter)
-    assert len(matching_messages) < 2
+    origin_id_prefix = f"csv_{csv_hash}.row_"
+    csv_messages_filter = lambda q: q \
+        .where(filter=FieldFilter("origin.origin_id", ">=", origin_id_prefix)) \
+        .where(filter=FieldFilter("origin.origin_id", "<", f"{origin_id_prefix}\uf8ff"))
+    csv_messages = engagement_db.get_messages(firestore_query_filter=csv_messages_filter, batch_size=500)
+
+    origin_ids = {msg.origin.origin_id for msg in csv_messages}
+    assert len(origin_ids) == len(csv_messages), f"Multiple messages in the engagement database had the same " \
+                                                 f"origin id from csv '{csv_hash}'"
 
-    return len(matching_messages) > 0
+    return origin_ids
 
 
-def _ensure_engagement_db_has_message(engagement_db, message, message_origin_details, dry_run=False):
+def _ensure_engagement_db_has_message(message, message_origin_details, engagement_db_origin_ids, pending_writes):
     """
-    Ensures that the given message exists in an engagement database.
+    Ensures that the given message will exist in an engagement database, once `pending_writes` have been written
+    using `write_messages_to_engagement_db`.
 
-    This function will only write to the database if a message with the same origin_id doesn't already exist in the
-    database.
+    This function will only queue a write if a message with the same origin_id doesn't already exist in the database.
 
-    :param engagement_db: Engagement database to use.
-    :type engagement_db: engagement_database.EngagementDatabase
     :param message: Message to make sure exists in the engagement database.
     :type message: engagement_database.data_models.Message
     :param message_origin_details: Message origin details, to be logged in the HistoryEntryOrigin.details.
     :type message_origin_details: dict
-    :param dry_run: Whether to perform a dry run.
-    :type dry_run: bool
+    :param engagement_db_origin_ids: Origin ids of the messages already in the engagement database that could match
+                                     this message. Updated with the message's origin id if the message is added.
+    :type engagement_db_origin_ids: set of str
+    :param pending_writes: Messages waiting to be written to the engagement database. If this message needs adding,
+                           it is appended here with its HistoryEntryOrigin.
+    :type pending_writes: list of (engagement_database.data_models.Message,
+                          engagement_database.data_models.HistoryEntryOrigin)
     :return sync_events: Sync event.
     :rtype str
     """
-    if _engagement_db_has_message(engagement_db, message):
+    if message.origin.origin_id in engagement_db_origin_ids:
         log.debug(f"Message already in engagement database")
         return CSVSyncEvents.MESSAGE_ALREADY_IN_ENGAGEMENT_DB
 
     log.debug(f"Adding message to engagement database dataset {message.dataset}...")
-    if not dry_run:
-        engagement_db.set_message(
-            message,
-            HistoryEntryOrigin(origin_name="CSV -> Database Sync", details=message_origin_details)
-        )
+    pending_writes.append(
+        (message, HistoryEntryOrigin(origin_name="CSV -> Database Sync", details=message_origin_details))
+    )
+    engagement_db_origin_ids.add(message.origin.origin_id)
     return CSVSyncEvents.ADD_MESSAGE_TO_ENGAGEMENT_DB
 
 
-def _sync_csv_to_engagement_db(google_cloud_credentials_file_path, csv_source, engagement_db, uuid_table, cache=None,
-                               dry_run=False):
+class _CSVHashLocks:
+    """
+    Creates one lock per csv hash, so that concurrent syncs of csvs with the same contents can run one at a time.
+    """
+    def __init__(self):
+        self._locks = dict()  # of csv hash -> threading.Lock
+        self._locks_lock = threading.Lock()
+
+    def get_lock(self, csv_hash):
+        """
+        :param csv_hash: Hash of the csv to get the lock for.
+        :type csv_hash: str
+        :return: Lock for csvs with this hash.
+        :rtype: threading.Lock
+        """
+        with self._locks_lock:
+            if csv_hash not in self._locks:
+                self._locks[csv_hash] = threading.Lock()
+            return self._locks[csv_hash]
+
+
+def _sync_csv_to_engagement_db(google_cloud_credentials_file_path, csv_source, engagement_db, uuid_table,
+                               csv_hash_locks, cache=None, dry_run=False):
     """
     Syncs a CSV to an engagement database.
 
@@ -150,6 +437,9 @@ def _sync_csv_to_engagement_db(google_cloud_credentials_file_path, csv_source, e
     :type engagement_db: engagement_database.EngagementDatabase
     :param uuid_table: UUID table to use to re-identify the URNs so we can set the channel operator.
     :type uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+    :param csv_hash_locks: Locks to hold while syncing the csv, shared with the other csv syncs that are running
+                           concurrently.
+    :type csv_hash_locks: _CSVHashLocks
     :param cache: CSV sync cache or None. If specified, terminates the CSV sync if the csv had already been processed or 
                   differs since the last time it was requested. If None, processes the messages in the CSV.
     :type cache: src.common.cache.Cache | None
@@ -159,53 +449,91 @@ def _sync_csv_to_engagement_db(google_cloud_credentials_file_path, csv_source, e
     :rtype: (CSVToEngagementDBSyncStats, CSVToEngagementDBDatasetSyncStats)
     """
     csv_sync_stats = CSVToEngagementDBSyncStats()
-    dataset_to_sync_stats = defaultdict(lambda: CSVToEngagementDBDatasetSyncStats()) 
-
+    # Create the stats for every dataset this csv can sync to up-front, so the summaries can report on all of them.
+    dataset_to_sync_stats = {
+        csv_dataset_config.engagement_db_dataset: CSVToEngagementDBDatasetSyncStats()
+        for csv_dataset_config in csv_source.engagement_db_datasets
+    }
+
+    # Download the csv to a temporary file rather than into memory, so that peak memory use is independent of the
+    # csv's size.
     log.info(f"Downloading csv from '{csv_source.gs_url}'...")
-    raw_csv_string = google_cloud_utils.download_blob_to_string(
-        google_cloud_credentials_file_path, csv_source.gs_url)
-    csv_hash = SHAUtils.sha_string(raw_csv_string)
-    raw_data = list(csv.DictReader(StringIO(raw_csv_string)))
-    log.info(f"Downloaded {len(raw_data)} messages in csv '{csv_source.gs_url}'")
-
-    # Convert the gs_url to a format that is safe to use as a cache entry name.
-    escaped_csv_url = urllib.parse.quote_plus(csv_source.gs_url)
-    if cache is None:
-        prev_csv_hash = None
-    else:
-        prev_csv_hash = cache.get_string(escaped_csv_url)
-
-    if prev_csv_hash is not None:
-        assert csv_hash == prev_csv_hash, f"CSV '{csv_source.gs_url}' differs since the last time it was requested. " \
-                                          f"To avoid accidental duplication, please inspect the problem, then clear " \
-                                          f"the cache and re-run when it is safe to proceed."
-        log.info("This file matches a previous version of the file that was processed in the past.")
-        log.info("Returning without reprocessing any of the messages in this file.")
-        return csv_sync_stats, dataset_to_sync_stats
-
-    for i, csv_msg in enumerate(raw_data):
-        log.info(f"Processing message {i + 1}/{len(raw_data)}...")
-        csv_sync_stats.add_event(CSVSyncEvents.READ_ROW_FROM_CSV)
-        engagement_db_message = _csv_message_to_engagement_db_message(
-            csv_msg, uuid_table, f"csv_{csv_hash}.row_{i}", csv_source
-        )
-
-        if engagement_db_message is None:
-            log.info(f"No matching dataset for this message, sent at time '{csv_msg['ReceivedOn']}'")
-            csv_sync_stats.add_event(CSVSyncEvents.MESSAGE_SKIPPED_NO_MATCHING_TIMESTAMP)
-            continue
-
-        message_origin_details = {
-            "csv_row_number": i,
-            "csv_row_data": csv_msg,
-            "csv_sync_configuration": csv_source.to_dict(serialize_datetimes_to_str=True),
-            "csv_hash": csv_hash
-        }
-        sync_event = _ensure_engagement_db_has_message(engagement_db, engagement_db_message, message_origin_details, dry_run)
-        dataset_to_sync_stats[engagement_db_message.dataset].add_event(sync_event)
-
-    if cache is not None and not dry_run:
-        cache.set_string(escaped_csv_url, csv_hash)
+    with tempfile.TemporaryFile() as raw_csv_file:
+        csv_hash = _download_csv_to_file(google_cloud_credentials_file_path, csv_source.gs_url, raw_csv_file)
+        log.info(f"Downloaded csv '{csv_source.gs_url}'")
+
+        # Csvs with the same contents sync messages with the same origin ids. Sync those one at a time, so that each
+        # sees the messages written by the others and doesn't write them to the engagement database again.
+        with csv_hash_locks.get_lock(csv_hash):
+            # Convert the gs_url to a format that is safe to use as a cache entry name.
+            escaped_csv_url = urllib.parse.quote_plus(csv_source.gs_url)
+            if cache is None:
+                prev_csv_hash = None
+            else:
+                prev_csv_hash = cache.get_string(escaped_csv_url)
+
+            if prev_csv_hash is not None:
+                assert csv_hash == prev_csv_hash, f"CSV '{csv_source.gs_url}' differs since the last time it was " \
+                                                  f"requested. To avoid accidental duplication, please inspect the " \
+                                                  f"problem, then clear the cache and re-run when it is safe to " \
+                                                  f"proceed."
+                log.info("This file matches a previous version of the file that was processed in the past.")
+                log.info("Returning without reprocessing any of the messages in this file.")
+                return csv_sync_stats, dataset_to_sync_stats
+
+            engagement_db_origin_ids = _get_origin_ids_in_engagement_db(engagement_db, csv_hash)
+            log.info(f"Found {len(engagement_db_origin_ids)} messages from this csv already in the engagement "
+                     f"database")
+
+            participant_uuids = set(_read_csv_column(raw_csv_file, "Sender"))
+            participant_channel_operators = _get_participant_channel_operators(uuid_table, participant_uuids)
+
+            parse_date_string = _make_date_parser(csv_source.timezone)
+            # The sync configuration is the same for every row, so only serialize it once.
+            csv_sync_configuration = csv_source.to_dict(serialize_datetimes_to_str=True)
+            pending_writes = []  # of (Message, HistoryEntryOrigin)
+            seen_rows = set()  # of (Sender, Message, ReceivedOn)
+            # Stream the csv rows from the downloaded file as we process them, rather than materializing the whole csv
+            # in memory.
+            for i, csv_msg in enumerate(_read_csv_rows(raw_csv_file)):
+                log.info(f"Processing message {i + 1}...")
+                csv_sync_stats.add_event(CSVSyncEvents.READ_ROW_FROM_CSV)
+
+                if csv_source.skip_duplicate_rows:
+                    row_key = (csv_msg["Sender"], csv_msg["Message"], csv_msg["ReceivedOn"])
+                    if row_key in seen_rows:
+                        log.info("Skipping message that duplicates an earlier row in this csv")
+                        csv_sync_stats.add_event(CSVSyncEvents.MESSAGE_SKIPPED_DUPLICATE_IN_CSV)
+                        continue
+                    seen_rows.add(row_key)
+
+                engagement_db_message = _csv_message_to_engagement_db_message(
+                    csv_msg, participant_channel_operators, f"csv_{csv_hash}.row_{i}", csv_source, parse_date_string
+                )
+
+                if engagement_db_message is None:
+                    log.info(f"No matching dataset for this message, sent at time '{csv_msg['ReceivedOn']}'")
+                    csv_sync_stats.add_event(CSVSyncEvents.MESSAGE_SKIPPED_NO_MATCHING_TIMESTAMP)
+                    continue
+
+                message_origin_details = {
+                    "csv_row_number": i,
+                    "csv_row_data": csv_msg,
+                    "csv_sync_configuration": csv_sync_configuration,
+                    "csv_hash": csv_hash
+                }
+                sync_event = _ensure_engagement_db_has_message(
+                    engagement_db_message, message_origin_details, engagement_db_origin_ids, pending_writes
+                )
+                dataset_to_sync_stats[engagement_db_message.dataset].add_event(sync_event)
+
+                if len(pending_writes) >= _MAX_MESSAGES_PER_WRITE_BATCH:
+                    write_messages_to_engagement_db(engagement_db, pending_writes, dry_run)
+
+            write_messages_to_engagement_db(engagement_db, pending_writes, dry_run)
+
+            if cache is not None and not dry_run:
+                cache.set_string(escaped_csv_url, csv_hash)
 
     return csv_sync_stats, dataset_to_sync_stats
 
@@ -240,15 +568,27 @@ def sync_csvs_to_engagement_db(google_cloud_credentials_file_path, csv_sources,
     else:
         cache = Cache(f"{cache_path}/csv_to_engagement_db")
 
+    # Sync the csvs concurrently, because each sync spends most of its time waiting on Google Cloud Storage and
+    # Firestore.
+    csv_hash_locks = _CSVHashLocks()
     csv_source_to_csv_sync_stats = dict() # of gs_url_source -> CSVToEngagementDBSyncStats
     csv_source_to_dataset_to_sync_stats = dict() # of gs_url_source -> Engagement DB dataset -> CSVToEngagementDBDatasetSyncStats
-    for i, csv_source in enumerate(csv_sources):
-        log.info(f"Syncing csv {i + 1}/{len(csv_sources)}: {csv_source.gs_url}...")
-        csv_source_stats, dataset_to_sync_stats = _sync_csv_to_engagement_db(
-            google_cloud_credentials_file_path, csv_source, engagement_db, uuid_table, cache, dry_run
-        )
-        csv_source_to_csv_sync_stats[csv_source.gs_url] = csv_source_stats
-        csv_source_to_dataset_to_sync_stats[csv_source.gs_url] = dataset_to_sync_stats
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_CSV_SYNCS) as executor:
+        future_to_csv_source = dict()
+        for csv_source in csv_sources:
+            future = executor.submit(
+                _sync_csv_to_engagement_db,
+                google_cloud_credentials_file_path, csv_source, engagement_db, uuid_table, csv_hash_locks, cache,
+                dry_run
+            )
+            future_to_csv_source[future] = csv_source
+
+        for i, future in enumerate(as_completed(future_to_csv_source)):
+            csv_source = future_to_csv_source[future]
+            csv_source_stats, dataset_to_sync_stats = future.result()
+            log.info(f"Synced csv {i + 1}/{len(csv_sources)}: {csv_source.gs_url}")
+            csv_source_to_csv_sync_stats[csv_source.gs_url] = csv_source_stats
+            csv_source_to_dataset_to_sync_stats[csv_source.gs_url] = dataset_to_sync_stats
 
     # Log the summaries of actions taken for each csv and for each dataset.
     all_csv_sync_stats = CSVToEngagementDBSyncStats()
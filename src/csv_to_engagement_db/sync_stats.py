@@ -10,19 +10,23 @@ class CSVSyncEvents:
     MESSAGE_ALREADY_IN_ENGAGEMENT_DB = "message_already_in_engagement_db"
     ADD_MESSAGE_TO_ENGAGEMENT_DB = "add_message_to_engagement_db"
     MESSAGE_SKIPPED_NO_MATCHING_TIMESTAMP = "message_skipped_no_matching_timestamp"
+    MESSAGE_SKIPPED_DUPLICATE_IN_CSV = "message_skipped_duplicate_in_csv"
 
 
 class CSVToEngagementDBSyncStats(SyncStats):
     def __init__(self):
         super().__init__({
             CSVSyncEvents.READ_ROW_FROM_CSV: 0,
-            CSVSyncEvents.MESSAGE_SKIPPED_NO_MATCHING_TIMESTAMP: 0
+            CSVSyncEvents.MESSAGE_SKIPPED_NO_MATCHING_TIMESTAMP: 0,
+            CSVSyncEvents.MESSAGE_SKIPPED_DUPLICATE_IN_CSV: 0
         })
 
     def print_summary(self):
         log.info(f"CSV rows read: {self.event_counts[CSVSyncEvents.READ_ROW_FROM_CSV]}")
         log.info(f"Messages skipped because they didn't match a dataset time-range: " \
                  f"{self.event_counts[CSVSyncEvents.MESSAGE_SKIPPED_NO_MATCHING_TIMESTAMP]}")
+        log.info(f"Messages skipped because they duplicated an earlier row in the csv: "
+                 f"{self.event_counts[CSVSyncEvents.MESSAGE_SKIPPED_DUPLICATE_IN_CSV]}")
 
 
 class CSVToEngagementDBDatasetSyncStats(SyncStats):
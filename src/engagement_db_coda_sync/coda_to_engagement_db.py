@@ -1,14 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
 from core_data_modules.logging import Logger
 from engagement_database.data_models import MessageStatuses
 from google.cloud import firestore
 from google.cloud.firestore_v1 import FieldFilter
 
+from src.common.engagement_db_transactions import run_in_engagement_db_transaction
 from src.engagement_db_coda_sync.cache import CodaSyncCache
-from src.engagement_db_coda_sync.lib import _update_engagement_db_message_from_coda_message
+from src.engagement_db_coda_sync.lib import _update_engagement_db_message_from_coda_message, \
+    _engagement_db_message_matches_coda_message
 from src.engagement_db_coda_sync.sync_stats import CodaToEngagementDBSyncStats, CodaSyncEvents
 
 log = Logger(__name__)
 
+# Maximum number of Coda datasets to sync to the engagement database concurrently.
+_MAX_CONCURRENT_DATASET_SYNCS = 8
+
+# Maximum number of Coda messages in a dataset to sync to the engagement database concurrently.
+_MAX_CONCURRENT_MESSAGE_SYNCS = 8
+
 
 @firestore.transactional
 def _sync_coda_message_to_engagement_db_batch(transaction, coda, coda_message, engagement_db, engagement_db_dataset,
@@ -63,15 +74,18 @@ def _sync_coda_message_to_engagement_db_batch(transaction, coda, coda_message, e
     log.info(f"{len(engagement_db_messages)} engagement db message(s) match Coda message {coda_message.message_id} "
              f"in this batch")
 
-    for _ in engagement_db_messages:
-        sync_stats.add_event(CodaSyncEvents.READ_MESSAGE_FROM_ENGAGEMENT_DB)
+    sync_stats.add_event_count(CodaSyncEvents.READ_MESSAGE_FROM_ENGAGEMENT_DB, len(engagement_db_messages))
 
     # Update each of the matching messages with the labels currently in Coda.
+    # Serialize the Coda message for the history entries the first time a matching message needs updating, then reuse
+    # it for the rest, rather than serializing it once per message or when no message needs updating.
+    serialize_coda_message = lru_cache(maxsize=None)(lambda: coda_message.to_dict(serialize_datetimes_to_str=True))
     for i, engagement_db_message in enumerate(engagement_db_messages):
         log.info(f"Processing matching engagement message {i + 1}/{len(engagement_db_messages)}: "
                  f"{engagement_db_message.message_id}...")
         message_sync_events = _update_engagement_db_message_from_coda_message(
-            engagement_db, coda, engagement_db_message, coda_message, coda_config, transaction=transaction, dry_run=dry_run
+            engagement_db, coda, engagement_db_message, coda_message, coda_config, transaction=transaction,
+            dry_run=dry_run, serialize_coda_message=serialize_coda_message
         )
         sync_stats.add_events(message_sync_events)
 
@@ -83,11 +97,15 @@ def _sync_coda_message_to_engagement_db_batch(transaction, coda, coda_message, e
     return next_start_after, sync_stats
 
 
-def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engagement_db_dataset, coda_config, dry_run=False):
+def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engagement_db_dataset, coda_config,
+                                        engagement_db_messages_by_coda_id=None, dry_run=False):
     """
     Syncs a coda message to an engagement database, by downloading all the engagement database messages which match the
     coda message's id and dataset, and making sure the labels match.
 
+    If `engagement_db_messages_by_coda_id` is provided and all the messages in it that match the coda message are
+    already up to date, returns without downloading anything.
+
     :param coda: Coda instance to sync from.
     :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
     :param coda_message: Coda Message to sync.
@@ -98,6 +116,9 @@ def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engag
     :type engagement_db_dataset: str
     :param coda_config: Configuration for the update.
     :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param engagement_db_messages_by_coda_id: All the messages in `engagement_db_dataset`, indexed by coda id, or None.
+                                              Construct using `_get_engagement_db_messages_by_coda_id`.
+    :type engagement_db_messages_by_coda_id: dict of str -> list of engagement_database.data_models.Message | None
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
     :return Sync stats.
@@ -105,6 +126,16 @@ def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engag
     """
     sync_stats = CodaToEngagementDBSyncStats()
 
+    if engagement_db_messages_by_coda_id is not None:
+        matching_messages = engagement_db_messages_by_coda_id.get(coda_message.message_id, [])
+        if all(_engagement_db_message_matches_coda_message(msg, coda_message, coda_config)
+               for msg in matching_messages):
+            log.info(f"All {len(matching_messages)} engagement db message(s) matching Coda message "
+                     f"{coda_message.message_id} are up to date")
+            sync_stats.add_event_count(CodaSyncEvents.READ_MESSAGE_FROM_ENGAGEMENT_DB, len(matching_messages))
+            sync_stats.add_event_count(CodaSyncEvents.LABELS_MATCH, len(matching_messages))
+            return sync_stats
+
     # Sync the coda message by fetching and updating the matching engagement db messages in 1 or more batches.
     # (A multiple-batch approach is needed because the number of matching messages may exceed the Firestore batch limit)
     start_after = None
@@ -112,9 +143,9 @@ def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engag
     batches = 0
     while first_run or start_after is not None:
         first_run = False
-        start_after, batch_sync_stats = _sync_coda_message_to_engagement_db_batch(
-            engagement_db.transaction(), coda, coda_message, engagement_db, engagement_db_dataset, coda_config,
-            start_after, dry_run
+        start_after, batch_sync_stats = run_in_engagement_db_transaction(
+            engagement_db, _sync_coda_message_to_engagement_db_batch,
+            coda, coda_message, engagement_db, engagement_db_dataset, coda_config, start_after, dry_run
         )
         sync_stats.add_stats(batch_sync_stats)
         batches += 1
@@ -123,6 +154,33 @@ def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engag
     return sync_stats
 
 
+def _get_engagement_db_messages_by_coda_id(engagement_db, engagement_db_dataset):
+    """
+    Downloads all the live and stale messages in an engagement database dataset, in one query, indexed by coda id.
+
+    :param engagement_db: Engagement database to download from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param engagement_db_dataset: Dataset in the engagement database to download.
+    :type engagement_db_dataset: str
+    :return: Dictionary of coda id -> messages in the dataset with that coda id.
+    :rtype: dict of str -> list of engagement_database.data_models.Message
+    """
+    log.info(f"Downloading all messages in engagement db dataset {engagement_db_dataset}...")
+    engagement_db_messages = engagement_db.get_messages(
+        firestore_query_filter=lambda q: q
+            .where(filter=FieldFilter("dataset", "==", engagement_db_dataset))
+            .where(filter=FieldFilter("status", "in", [MessageStatuses.LIVE, MessageStatuses.STALE])),
+        batch_size=500
+    )
+    log.info(f"Downloaded {len(engagement_db_messages)} messages")
+
+    engagement_db_messages_by_coda_id = dict()  # of coda id -> list of Message
+    for msg in engagement_db_messages:
+        if msg.coda_id is not None:
+            engagement_db_messages_by_coda_id.setdefault(msg.coda_id, []).append(msg)
+    return engagement_db_messages_by_coda_id
+
+
 def _sync_coda_dataset_to_engagement_db(coda, engagement_db, coda_config, dataset_config, cache=None, dry_run=False):
     """
     Syncs messages from one Coda dataset to an engagement database.
@@ -144,32 +202,48 @@ def _sync_coda_dataset_to_engagement_db(coda, engagement_db, coda_config, datase
 
     sync_stats = CodaToEngagementDBSyncStats()
 
-    coda_messages = coda.get_dataset_messages(
-        dataset_config.coda_dataset_id,
-        last_updated_after=None if cache is None else cache.get_last_updated_timestamp(dataset_config.coda_dataset_id)
-    )
+    last_updated_after = None if cache is None else cache.get_last_updated_timestamp(dataset_config.coda_dataset_id)
+    coda_messages = coda.get_dataset_messages(dataset_config.coda_dataset_id, last_updated_after=last_updated_after)
     for _ in coda_messages:
         sync_stats.add_event(CodaSyncEvents.READ_MESSAGE_FROM_CODA)
 
     coda_messages.sort(key=lambda msg: msg.last_updated)
 
-    for i, coda_message in enumerate(coda_messages):
-        log.info(f"Processing Coda message {i + 1}/{len(coda_messages)}: {coda_message.message_id}...")
-        message_sync_stats = _sync_coda_message_to_engagement_db(
-            coda, coda_message, engagement_db, dataset_config.engagement_db_dataset, coda_config, dry_run
+    # If we're syncing every message in this Coda dataset, download the engagement db dataset once up-front, so we
+    # can skip the per-message queries and transactions for the Coda messages whose engagement db messages already
+    # match. Incremental syncs only see the few Coda messages that changed, which will usually need updating anyway.
+    engagement_db_messages_by_coda_id = None
+    if last_updated_after is None:
+        engagement_db_messages_by_coda_id = _get_engagement_db_messages_by_coda_id(
+            engagement_db, dataset_config.engagement_db_dataset
         )
-        sync_stats.add_stats(message_sync_stats)
 
-        # If there's a cache and we've read the last message, or the next message's last updated timestamp is greater
-        # than the message we are currently syncing, update the cache.
+    # Sync the Coda messages in chunks, concurrently within each chunk. Each Coda message updates a different set of
+    # engagement db messages, but the chunks are synced in turn, so the cache can still be advanced in timestamp order.
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_MESSAGE_SYNCS) as executor:
+        for chunk_start in range(0, len(coda_messages), _MAX_CONCURRENT_MESSAGE_SYNCS):
+            chunk = coda_messages[chunk_start:chunk_start + _MAX_CONCURRENT_MESSAGE_SYNCS]
+            log.info(f"Processing Coda messages {chunk_start + 1}-{chunk_start + len(chunk)}/{len(coda_messages)}...")
+            for message_sync_stats in executor.map(
+                lambda coda_message: _sync_coda_message_to_engagement_db(
+                    coda, coda_message, engagement_db, dataset_config.engagement_db_dataset, coda_config,
+                    engagement_db_messages_by_coda_id, dry_run
+                ),
+                chunk
+            ):
+                sync_stats.add_stats(message_sync_stats)
 
-        have_read_last_message = (i == len(coda_messages) - 1)
-        # Note that this ensures we don't update the time-based cache when we are processing messages with the same timestamp.
-        if not have_read_last_message:
-            has_timestamp_changed = coda_messages[i + 1].last_updated > coda_message.last_updated
+            if dry_run or cache is None:
+                continue
 
-        if not dry_run and cache is not None and (have_read_last_message or has_timestamp_changed):
-            cache.set_last_updated_timestamp(dataset_config.coda_dataset_id, coda_message.last_updated)
+            # Update the cache to the timestamp of the latest message synced so far that isn't followed by another
+            # message with the same timestamp. This ensures we don't update the time-based cache when we are part way
+            # through processing messages with the same timestamp.
+            for i in reversed(range(chunk_start, chunk_start + len(chunk))):
+                have_read_last_message = (i == len(coda_messages) - 1)
+                if have_read_last_message or coda_messages[i + 1].last_updated > coda_messages[i].last_updated:
+                    cache.set_last_updated_timestamp(dataset_config.coda_dataset_id, coda_messages[i].last_updated)
+                    break
 
     return sync_stats
 
@@ -198,13 +272,23 @@ def sync_coda_to_engagement_db(coda, engagement_db, coda_config, cache_path=None
         log.info(f"Initialising Coda sync cache at '{cache_path}/coda_to_engagement_db'")
         cache = CodaSyncCache(f"{cache_path}/coda_to_engagement_db")
 
-    # Sync each Coda dataset to the engagement db in turn
+    # Sync the Coda datasets to the engagement db concurrently, because each dataset is synced independently and
+    # spends most of its time waiting on Coda and Firestore.
     dataset_to_sync_stats = dict()  # of coda dataset id -> CodaToEngagementDBSyncStats
-    for dataset_config in coda_config.dataset_configurations:
-        log.info(f"Syncing Coda dataset {dataset_config.coda_dataset_id} to engagement db dataset "
-                 f"{dataset_config.engagement_db_dataset}")
-        dataset_sync_stats = _sync_coda_dataset_to_engagement_db(coda, engagement_db, coda_config, dataset_config, cache, dry_run)
-        dataset_to_sync_stats[dataset_config.coda_dataset_id] = dataset_sync_stats
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_DATASET_SYNCS) as executor:
+        future_to_dataset_config = dict()
+        for dataset_config in coda_config.dataset_configurations:
+            log.info(f"Syncing Coda dataset {dataset_config.coda_dataset_id} to engagement db dataset "
+                     f"{dataset_config.engagement_db_dataset}")
+            future = executor.submit(
+                _sync_coda_dataset_to_engagement_db,
+                coda, engagement_db, coda_config, dataset_config, cache, dry_run
+            )
+            future_to_dataset_config[future] = dataset_config
+
+        for future in as_completed(future_to_dataset_config):
+            dataset_config = future_to_dataset_config[future]
+            dataset_to_sync_stats[dataset_config.coda_dataset_id] = future.result()
 
     # Log the summaries of actions taken for each dataset then for all datasets combined.
     all_sync_stats = CodaToEngagementDBSyncStats()
@@ -1,4 +1,6 @@
 class CodeSchemeConfiguration:
+    __slots__ = ("code_scheme", "auto_coder", "coda_code_schemes_count")
+
     def __init__(self, code_scheme, auto_coder=None, coda_code_schemes_count=1):
         """
         Configures one normal code scheme in a Coda dataset.
@@ -31,6 +33,10 @@ class CodeSchemeConfiguration:
 
 
 class CodaDatasetConfiguration:
+    __slots__ = ("coda_dataset_id", "engagement_db_dataset", "code_scheme_configurations", "ws_code_match_value",
+                 "dataset_users_file_url", "update_users_and_code_schemes", "_auto_coded_scheme_configurations",
+                 "_valid_code_ids_lut")
+
     def __init__(self, coda_dataset_id, engagement_db_dataset, code_scheme_configurations, ws_code_match_value,
                  dataset_users_file_url=None, update_users_and_code_schemes=True):
         """
@@ -44,7 +50,7 @@ class CodaDatasetConfiguration:
                                            can be used for labelling messages in this dataset, *except the WS - Correct
                                            Dataset configuration*. The WS - Correct Dataset configuration should be set
                                            globally from a `CodaSyncConfiguration`.
-        :type code_scheme_configurations: list of CodeSchemeConfiguration
+        :type code_scheme_configurations: iterable of CodeSchemeConfiguration
         :param ws_code_match_value: Match value of the code in the
                                     `CodaSyncConfiguration.ws_correct_dataset_code_scheme` that identifies this dataset.
                                     If a message in another dataset is labelled as WS, and the WS - Correct Dataset
@@ -63,13 +69,49 @@ class CodaDatasetConfiguration:
         """
         self.coda_dataset_id = coda_dataset_id
         self.engagement_db_dataset = engagement_db_dataset
-        self.code_scheme_configurations = code_scheme_configurations
+        self.code_scheme_configurations = tuple(code_scheme_configurations)
         self.ws_code_match_value = ws_code_match_value
         self.dataset_users_file_url = dataset_users_file_url
         self.update_users_and_code_schemes = update_users_and_code_schemes
 
+        # Index the code scheme configurations that have an auto-coder, so that adding a message to Coda only needs
+        # to consider the schemes it might actually auto-code under.
+        self._auto_coded_scheme_configurations = [
+            scheme_config for scheme_config in self.code_scheme_configurations if scheme_config.auto_coder is not None
+        ]
+
+        # Index the code ids in each code scheme, so that validating the labels of each message added to Coda doesn't
+        # need to rebuild this.
+        self._valid_code_ids_lut = {
+            scheme_config.code_scheme.scheme_id: {code.code_id for code in scheme_config.code_scheme.codes}
+            for scheme_config in self.code_scheme_configurations
+        }
+
+    def get_auto_coded_scheme_configurations(self):
+        """
+        Gets the code scheme configurations in this dataset that have an auto-coder.
+
+        :return: Code scheme configurations with an auto-coder, in the order they are configured.
+        :rtype: list of CodeSchemeConfiguration
+        """
+        return self._auto_coded_scheme_configurations
+
+    def get_valid_code_ids_lut(self):
+        """
+        Gets the ids of the codes in each of this dataset's code schemes.
+
+        :return: Dictionary of scheme id -> ids of the codes in that scheme.
+        :rtype: dict of str -> set of str
+        """
+        return self._valid_code_ids_lut
+
 
 class CodaSyncConfiguration:
+    __slots__ = ("dataset_configurations", "ws_correct_dataset_code_scheme", "set_dataset_from_ws_string_value",
+                 "default_ws_dataset", "project_users_file_url", "_dataset_configs_by_engagement_db_dataset",
+                 "_dataset_config_indices_by_ws_code_match_value", "_ws_codes_by_match_value",
+                 "_ws_correct_dataset_code_ids")
+
     def __init__(self, dataset_configurations, ws_correct_dataset_code_scheme, set_dataset_from_ws_string_value=False,
                  default_ws_dataset=None, project_users_file_url=None):
         """
@@ -97,7 +139,7 @@ class CodaSyncConfiguration:
           4. Crash with a ValueError.
 
         :param dataset_configurations: Configurations for each of the Coda datasets to sync.
-        :type dataset_configurations: list of CodaDatasetConfiguration
+        :type dataset_configurations: iterable of CodaDatasetConfiguration
         :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
                                                This will be added to every dataset in Coda, and allows messages that
                                                have been assigned to the wrong dataset in Coda to be redirected to the
@@ -129,35 +171,65 @@ class CodaSyncConfiguration:
                                        the users will be updated from that file instead of the one referenced here.
         :type project_users_file_url: str | None
         """
-        self.dataset_configurations = dataset_configurations
+        self.dataset_configurations = tuple(dataset_configurations)
         self.ws_correct_dataset_code_scheme = ws_correct_dataset_code_scheme
         self.set_dataset_from_ws_string_value = set_dataset_from_ws_string_value
         self.default_ws_dataset = default_ws_dataset
         self.project_users_file_url = project_users_file_url
 
+        # Index the dataset configurations so the per-message lookups below don't need to scan every configuration.
+        # Where multiple configurations share a key, the first one is indexed, matching the order a scan would find.
+        self._dataset_configs_by_engagement_db_dataset = dict()
+        self._dataset_config_indices_by_ws_code_match_value = dict()
+        for i, config in enumerate(self.dataset_configurations):
+            self._dataset_configs_by_engagement_db_dataset.setdefault(config.engagement_db_dataset, config)
+            self._dataset_config_indices_by_ws_code_match_value.setdefault(config.ws_code_match_value, i)
+
+        # Index the ws_correct_dataset_code_scheme's codes by match value, so validating each dataset configuration's
+        # ws_code_match_value doesn't need to scan every code in the scheme.
+        self._ws_codes_by_match_value = dict()
+        for code in ws_correct_dataset_code_scheme.codes:
+            for match_value in code.match_values or []:
+                self._ws_codes_by_match_value.setdefault(match_value, code)
+        self._ws_correct_dataset_code_ids = {code.code_id for code in ws_correct_dataset_code_scheme.codes}
+
         self.validate()
 
     def validate(self):
         # Ensure that all the ws_code_match_values match a code in the ws_correct_dataset_code_scheme.
-        for dataset in self.dataset_configurations:
-            try:
-                self.ws_correct_dataset_code_scheme.get_code_with_match_value(dataset.ws_code_match_value)
-            except KeyError as e:
-                raise KeyError(f"A dataset_configuration in the CodaSyncConfiguration had a ws_code_match_value "
-                               f"'{dataset.ws_code_match_value}', but this does not match any code in the "
-                               f"ws_correct_dataset_code_scheme. Add this code to the ws_correct_dataset_code_scheme "
-                               f"or remove this dataset_configuration") from e
+        # Check every dataset before raising, so that all the missing codes can be fixed at once.
+        unmatched_ws_code_match_values = [
+            dataset.ws_code_match_value for dataset in self.dataset_configurations
+            if dataset.ws_code_match_value not in self._ws_codes_by_match_value
+        ]
+        if len(unmatched_ws_code_match_values) > 0:
+            raise KeyError(f"{len(unmatched_ws_code_match_values)} dataset_configuration(s) in the CodaSyncConfiguration "
+                           f"had a ws_code_match_value that does not match any code in the "
+                           f"ws_correct_dataset_code_scheme: {unmatched_ws_code_match_values}. Add these codes to the "
+                           f"ws_correct_dataset_code_scheme or remove these dataset_configurations")
+
+    def get_ws_correct_dataset_code_ids(self):
+        """
+        Gets the ids of the codes in the ws_correct_dataset_code_scheme.
+
+        :return: Ids of the codes in the ws_correct_dataset_code_scheme.
+        :rtype: set of str
+        """
+        return self._ws_correct_dataset_code_ids
 
     def get_dataset_config_by_engagement_db_dataset(self, dataset):
-        for config in self.dataset_configurations:
-            if config.engagement_db_dataset == dataset:
-                return config
+        config = self._dataset_configs_by_engagement_db_dataset.get(dataset)
+        if config is not None:
+            return config
         raise ValueError(f"Coda configuration does not contain a dataset_configuration with dataset '{dataset}'")
 
     def get_dataset_config_by_ws_code_match_value(self, ws_code_match_values):
-        for config in self.dataset_configurations:
-            for value in ws_code_match_values:
-                if config.ws_code_match_value == value:
-                    return config
+        # Return the earliest matching configuration, to preserve the priority order of `dataset_configurations`.
+        matching_config_indices = [
+            self._dataset_config_indices_by_ws_code_match_value[value] for value in ws_code_match_values
+            if value in self._dataset_config_indices_by_ws_code_match_value
+        ]
+        if len(matching_config_indices) > 0:
+            return self.dataset_configurations[min(matching_config_indices)]
         raise ValueError(f"Coda configuration does not contain a dateset_configuration with a ws_code_match_value "
                          f"in '{ws_code_match_values}'")
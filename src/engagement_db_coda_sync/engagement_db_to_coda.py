@@ -1,47 +1,126 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from core_data_modules.logging import Logger
 from core_data_modules.util import SHAUtils
 from engagement_database.data_models import MessageStatuses, HistoryEntryOrigin
 from google.cloud import firestore
 from google.cloud.firestore_v1 import FieldFilter
 
+from src.common.engagement_db_transactions import run_in_engagement_db_transaction, write_messages_to_engagement_db
 from src.engagement_db_coda_sync.cache import CodaSyncCache
-from src.engagement_db_coda_sync.lib import _update_engagement_db_message_from_coda_message, _add_message_to_coda
+from src.engagement_db_coda_sync.lib import _update_engagement_db_message_from_coda_message, _add_message_to_coda, \
+    _get_ws_correction_dataset, _clear_ws_cycle_labels_in_coda
 from src.engagement_db_coda_sync.sync_stats import EngagementDBToCodaSyncStats, CodaSyncEvents
 
 log = Logger(__name__)
 
+# Maximum number of datasets to sync to Coda concurrently.
+_MAX_CONCURRENT_DATASET_SYNCS = 8
 
-@firestore.transactional
-def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, coda_config, dataset_config, last_seen_message, dry_run=False):
-    """
-    Syncs a message from an engagement database to Coda.
+# Maximum number of engagement db messages to sync per batch. Each message set writes both the message and a
+# history entry, so this keeps each batch of writes within Firestore's 500-write limit.
+_MESSAGES_PER_BATCH = 250
 
-    This method:
-     - Gets the least recently updated message that was last updated after `last_seen_message`.
-     - Writes back a coda id if the engagement db message doesn't have one yet.
-     - Syncs the labels from Coda to this message if the message already exists in Coda.
-     - Creates a new message in Coda if this message hasn't been seen in Coda yet.
 
-    :param transaction: Transaction in the engagement database to perform the update in.
-    :type transaction: google.cloud.firestore.Transaction
-    :param engagement_db: Engagement database to sync from.
+class _CodaMessageCache:
+    def __init__(self, coda, coda_dataset_id):
+        """
+        In-memory cache of the messages looked-up in one Coda dataset during a sync run.
+
+        Engagement db messages with the same text share a coda_id, so this prevents downloading the same Coda message
+        again for every engagement db message that has that text.
+
+        Datasets are synced concurrently, and fixing a WS cycle in one dataset clears labels in the Coda datasets of
+        others, so a cache may be used by several threads at once. Each method holds a lock for its duration, including
+        any download, so that a message invalidated by one thread can't be overwritten by a download that another
+        thread started earlier.
+
+        :param coda: Coda instance to download messages from.
+        :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+        :param coda_dataset_id: Id of the Coda dataset to download messages from.
+        :type coda_dataset_id: str
+        """
+        self._coda = coda
+        self._coda_dataset_id = coda_dataset_id
+        self._messages = dict()  # of coda message id -> Coda message, or None if the message isn't in Coda
+        self._all_messages_cached = False
+        self._invalidated_message_ids = set()  # of coda message ids
+        self._lock = threading.Lock()
+
+    def prefetch_all_messages(self):
+        """
+        Downloads every message in this Coda dataset in one request, so that later look-ups don't need to query Coda.
+
+        This is only worthwhile when most of the dataset is going to be looked-up, e.g. on a non-incremental sync.
+        Does nothing if this dataset has already been prefetched.
+        """
+        with self._lock:
+            if self._all_messages_cached:
+                return
+
+            log.info(f"Prefetching all messages in Coda dataset {self._coda_dataset_id}...")
+            for coda_message in self._coda.get_dataset_messages(self._coda_dataset_id):
+                self._messages[coda_message.message_id] = coda_message
+            self._all_messages_cached = True
+            log.info(f"Prefetched {len(self._messages)} messages")
+
+    def get_message(self, coda_message_id):
+        """
+        Gets a message from this Coda dataset, downloading it from Coda only if it hasn't been looked-up before.
+
+        :param coda_message_id: Id of the Coda message to get.
+        :type coda_message_id: str
+        :return: Coda message with id `coda_message_id`, or None if there is no such message in this Coda dataset.
+        :rtype: core_data_modules.data_models.Message | None
+        """
+        with self._lock:
+            if coda_message_id not in self._messages:
+                if self._all_messages_cached and coda_message_id not in self._invalidated_message_ids:
+                    return None
+                self._messages[coda_message_id] = self._coda.get_dataset_message(
+                    self._coda_dataset_id, coda_message_id
+                )
+            return self._messages[coda_message_id]
+
+    def set_message(self, coda_message):
+        """
+        Updates the cache with a message that has just been written to this Coda dataset.
+
+        :param coda_message: Coda message to cache.
+        :type coda_message: core_data_modules.data_models.Message
+        """
+        with self._lock:
+            self._messages[coda_message.message_id] = coda_message
+
+    def invalidate_message(self, coda_message_id):
+        """
+        Marks a cached message as out of date, so that it will be downloaded from Coda again on the next look-up.
+
+        :param coda_message_id: Id of the Coda message to invalidate.
+        :type coda_message_id: str
+        """
+        with self._lock:
+            self._messages.pop(coda_message_id, None)
+            # The message is still in Coda, so make sure the next look-up downloads it rather than reporting it as
+            # missing from a prefetched dataset.
+            self._invalidated_message_ids.add(coda_message_id)
+
+
+def _get_next_engagement_db_messages(engagement_db, dataset_config, last_seen_message):
+    """
+    Gets the next batch of up to `_MESSAGES_PER_BATCH` messages in a dataset to sync, being the least recently updated
+    messages that were last updated after `last_seen_message`.
+
+    :param engagement_db: Engagement database to read from.
     :type engagement_db: engagement_database.EngagementDatabase
-    :param coda: Coda instance to sync the message to.
-    :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
-    :param coda_config: Coda sync configuration.
-    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
-    :param dataset_config: Configuration for the dataset to sync.
+    :param dataset_config: Configuration for the dataset to read from.
     :type dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
-    :param last_seen_message: Last seen message, downloaded from the database in a previous call, or None.
-                              If provided, downloads the least recently updated (next) message after this one, otherwise
-                              downloads the least recently updated message in the database.
+    :param last_seen_message: Last seen message, or None to start from the least recently updated message in the
+                              dataset.
     :type last_seen_message: engagement_database.data_models.Message | None
-    :param dry_run: Whether to perform a dry run.
-    :type dry_run: bool
-    :return: A tuple of:
-             1. The engagement database message that was synced. If there was no new message to sync, returns None.
-             2. Sync stats.
-    :rtype: (engagement_database.data_models.Message | None, src.engagement_db_coda_sync.sync_stats.EngagementDBToCodaSyncStats)
+    :return: The next messages to sync, sorted by last_updated then message_id.
+    :rtype: list of engagement_database.data_models.Message
     """
     if last_seen_message is None:
         messages_filter = lambda q: q \
@@ -49,10 +128,10 @@ def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, c
             .where(filter=FieldFilter("dataset", "==", dataset_config.engagement_db_dataset)) \
             .order_by("last_updated") \
             .order_by("message_id") \
-            .limit(1)
+            .limit(_MESSAGES_PER_BATCH)
     else:
-        # Get the next message after the last_seen_message, having sorted by last_updated than message_id
-        # Note: The last_seen_message can be the next/later message to be synced if it was updated
+        # Get the next messages after the last_seen_message, having sorted by last_updated than message_id
+        # Note: The last_seen_message can be a next/later message to be synced if it was updated
         messages_filter = lambda q: q \
             .where(filter=FieldFilter("status", "in", [MessageStatuses.LIVE, MessageStatuses.STALE])) \
             .where(filter=FieldFilter("dataset", "==", dataset_config.engagement_db_dataset)) \
@@ -60,23 +139,102 @@ def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, c
             .order_by("message_id") \
             .where(filter=FieldFilter("last_updated", ">=", last_seen_message.last_updated)) \
             .start_after({"last_updated": last_seen_message.last_updated, "message_id": last_seen_message.message_id}) \
-            .limit(1)
+            .limit(_MESSAGES_PER_BATCH)
+
+    return engagement_db.get_messages(firestore_query_filter=messages_filter)
+
+
+@firestore.transactional
+def _ws_correct_engagement_db_message(transaction, engagement_db, coda, coda_config, engagement_db_message,
+                                      coda_message, dry_run=False):
+    """
+    WS-corrects an engagement database message based on the labels in its Coda message, in a transaction.
+
+    The dataset to move the message to is chosen from the message's current state, so the message is read again in the
+    transaction and only updated if it hasn't changed since `engagement_db_message` was read. If it has changed, it
+    will be synced again when a later batch reaches its new `last_updated`.
+
+    If the correction fixes a WS cycle, the labels in Coda are not cleared here, so that no Coda writes are made in
+    (and replayed with) the transaction. Clear them using `_clear_ws_cycle_labels_in_coda` once the transaction has
+    committed, and only if the returned events include `CodaSyncEvents.FIX_WS_CYCLE`.
+
+    :param transaction: Transaction in the engagement database to perform the update in.
+    :type transaction: google.cloud.firestore.Transaction
+    :param engagement_db: Engagement database to update the message in.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param coda: Coda instance the message is being synced to.
+    :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+    :param coda_config: Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param engagement_db_message: Engagement database message to WS-correct, as read at the start of this batch.
+    :type engagement_db_message: engagement_database.data_models.Message
+    :param coda_message: Coda message to use to WS-correct the engagement database message.
+    :type coda_message: core_data_modules.data_models.Message
+    :param dry_run: Whether to perform a dry run.
+    :type dry_run: bool
+    :return: Sync events for the update.
+    :rtype: list of str
+    """
+    latest_messages = engagement_db.get_messages(
+        firestore_query_filter=lambda q: q
+            .where(filter=FieldFilter("message_id", "==", engagement_db_message.message_id)),
+        transaction=transaction
+    )
+    if len(latest_messages) == 0 or latest_messages[0].last_updated != engagement_db_message.last_updated:
+        log.info(f"Message {engagement_db_message.message_id} has changed since it was read; not WS-correcting it "
+                 f"in this batch")
+        return []
+
+    return _update_engagement_db_message_from_coda_message(
+        engagement_db, coda, latest_messages[0], coda_message, coda_config, transaction=transaction,
+        dry_run=dry_run, clear_ws_cycle_labels_in_coda=False
+    )
+
+
+def _sync_engagement_db_message_to_coda(engagement_db, coda, coda_config, dataset_config, coda_message_caches,
+                                        engagement_db_message, pending_writes, dry_run=False):
+    """
+    Syncs a message from an engagement database to Coda.
+
+    This method:
+     - Writes back a coda id if the engagement db message doesn't have one yet.
+     - Syncs the labels from Coda to this message if the message already exists in Coda.
+     - Creates a new message in Coda if this message hasn't been seen in Coda yet.
 
-    next_message_results = engagement_db.get_messages(firestore_query_filter=messages_filter, transaction=transaction)
+    Coda ids and label updates are appended to `pending_writes`, to be written to the engagement database in a batch
+    later. That write skips any message that has changed since it was read, which will be synced again from its new
+    `last_updated`. WS corrections are written immediately, each in its own transaction.
 
+    :param engagement_db: Engagement database to sync from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param coda: Coda instance to sync the message to.
+    :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+    :param coda_config: Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param dataset_config: Configuration for the dataset to sync.
+    :type dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
+    :param coda_message_caches: Dictionary of Coda dataset id -> cache of the messages in that Coda dataset, for every
+                                Coda dataset in the sync configuration. These are shared by all the dataset syncs.
+    :type coda_message_caches: dict of str -> _CodaMessageCache
+    :param engagement_db_message: Engagement database message to sync.
+    :type engagement_db_message: engagement_database.data_models.Message
+    :param pending_writes: List to append the engagement database writes needed by this sync to, as tuples of the
+                           message to write and the HistoryEntryOrigin to record.
+    :type pending_writes: list of (engagement_database.data_models.Message,
+                          engagement_database.data_models.HistoryEntryOrigin)
+    :param dry_run: Whether to perform a dry run.
+    :type dry_run: bool
+    :return: Sync stats.
+    :rtype: src.engagement_db_coda_sync.sync_stats.EngagementDBToCodaSyncStats
+    """
     sync_stats = EngagementDBToCodaSyncStats()
-    if len(next_message_results) == 0:
-        return None, sync_stats
-    else:
-        engagement_db_message = next_message_results[0]
-        sync_stats.add_event(CodaSyncEvents.READ_MESSAGE_FROM_ENGAGEMENT_DB)
 
     if engagement_db_message.text is None or engagement_db_message.text == "":
         # Don't sync messages that don't have text
         log.info(f"Message {engagement_db_message.message_id} is empty (.text == {engagement_db_message.text}), "
                  f"not adding to Coda")
         sync_stats.add_event(CodaSyncEvents.SKIP_EMPTY_MESSAGE)
-        return engagement_db_message, sync_stats
+        return sync_stats
 
     log.info(f"Syncing message {engagement_db_message.message_id}...")
     # Ensure the message has a valid coda id. If it doesn't have one yet, write one back to the database.
@@ -85,39 +243,108 @@ def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, c
         sync_stats.add_event(CodaSyncEvents.SET_CODA_ID)
         engagement_db_message.coda_id = SHAUtils.sha_string(engagement_db_message.text)
         if not dry_run:
-            engagement_db.set_message(
-                message=engagement_db_message,
-                origin=HistoryEntryOrigin(origin_name="Set coda_id", details={}),
-                transaction=transaction
-            )
+            pending_writes.append((engagement_db_message, HistoryEntryOrigin(origin_name="Set coda_id", details={})))
         # If we needed to set a coda id, don't make any other changes to this message on this sync.
         # We'll check the message is in coda and its labels match next time we fetch it.
         # This is to ensure we don't make two separate writes to history with the same timestamp, which would break
         # our ability to sort history by timestamp correctly.
-        return engagement_db_message, sync_stats
+        return sync_stats
     assert engagement_db_message.coda_id == SHAUtils.sha_string(engagement_db_message.text)
 
     # Look-up this message in Coda
-    coda_message = coda.get_dataset_message(dataset_config.coda_dataset_id, engagement_db_message.coda_id)
+    coda_message_cache = coda_message_caches[dataset_config.coda_dataset_id]
+    coda_message = coda_message_cache.get_message(engagement_db_message.coda_id)
 
     # If the message exists in Coda, update the database message based on the labels assigned in Coda
     if coda_message is not None:
         log.debug("Message already exists in Coda")
-        update_sync_events = _update_engagement_db_message_from_coda_message(
-            engagement_db, coda, engagement_db_message, coda_message, coda_config,
-            transaction=transaction, dry_run=dry_run
-        )
+        ws_correction_dataset = _get_ws_correction_dataset(engagement_db_message, coda_message, coda_config)
+        if ws_correction_dataset is None:
+            update_sync_events = _update_engagement_db_message_from_coda_message(
+                engagement_db, coda, engagement_db_message, coda_message, coda_config,
+                dry_run=dry_run, pending_writes=pending_writes
+            )
+        else:
+            # WS corrections move the message to a dataset chosen from what was read, so make these in their own
+            # transaction, which only touches the engagement database.
+            update_sync_events = run_in_engagement_db_transaction(
+                engagement_db, _ws_correct_engagement_db_message,
+                engagement_db, coda, coda_config, engagement_db_message, coda_message, dry_run
+            )
+
+            # If the transaction fixed a WS cycle, clear the labels of the cycle in Coda now that it has committed.
+            # This isn't done if the message changed and so wasn't corrected, which would leave Coda cleared but the
+            # engagement database unchanged.
+            if CodaSyncEvents.FIX_WS_CYCLE in update_sync_events:
+                cleared_coda_dataset_ids = _clear_ws_cycle_labels_in_coda(
+                    coda, engagement_db_message, coda_config, dry_run
+                )
+                # The labels of this message have changed in every Coda dataset in the cycle, including those being
+                # synced by other threads, so make sure the next look-up in each of them sees that.
+                for coda_dataset_id in cleared_coda_dataset_ids:
+                    coda_message_caches[coda_dataset_id].invalidate_message(engagement_db_message.coda_id)
         sync_stats.add_events(update_sync_events)
-        return engagement_db_message, sync_stats
+
+        return sync_stats
 
     # The message isn't in Coda, so add it
     sync_stats.add_event(CodaSyncEvents.ADD_MESSAGE_TO_CODA)
-    _add_message_to_coda(coda, dataset_config, coda_config.ws_correct_dataset_code_scheme, engagement_db_message, dry_run)
+    coda_message = _add_message_to_coda(coda, dataset_config, coda_config, engagement_db_message, dry_run)
+    coda_message_cache.set_message(coda_message)
 
-    return engagement_db_message, sync_stats
+    return sync_stats
 
 
-def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, dataset_config, cache, dry_run=False):
+def _sync_next_engagement_db_messages_to_coda_batch(engagement_db, coda, coda_config, dataset_config,
+                                                    coda_message_caches, last_seen_message, dry_run=False):
+    """
+    Syncs the next batch of up to `_MESSAGES_PER_BATCH` messages from an engagement database to Coda.
+
+    The messages are read and synced to Coda outside of any transaction, then the coda ids and labels that need
+    writing back to the engagement database are written together in a single batch.
+
+    :param engagement_db: Engagement database to sync from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param coda: Coda instance to sync the messages to.
+    :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+    :param coda_config: Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param dataset_config: Configuration for the dataset to sync.
+    :type dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
+    :param coda_message_caches: Dictionary of Coda dataset id -> cache of the messages in that Coda dataset, for every
+                                Coda dataset in the sync configuration.
+    :type coda_message_caches: dict of str -> _CodaMessageCache
+    :param last_seen_message: Last seen message, downloaded from the database in a previous call, or None.
+                              If provided, syncs the least recently updated (next) messages after this one, otherwise
+                              syncs the least recently updated messages in the database.
+    :type last_seen_message: engagement_database.data_models.Message | None
+    :param dry_run: Whether to perform a dry run.
+    :type dry_run: bool
+    :return: A tuple of:
+             1. The engagement database messages that were synced, in the order they were synced. If there were no
+                new messages to sync, returns an empty list.
+             2. Sync stats.
+    :rtype: (list of engagement_database.data_models.Message,
+             src.engagement_db_coda_sync.sync_stats.EngagementDBToCodaSyncStats)
+    """
+    engagement_db_messages = _get_next_engagement_db_messages(engagement_db, dataset_config, last_seen_message)
+
+    sync_stats = EngagementDBToCodaSyncStats()
+    pending_writes = []  # of (Message, HistoryEntryOrigin)
+    for engagement_db_message in engagement_db_messages:
+        sync_stats.add_event(CodaSyncEvents.READ_MESSAGE_FROM_ENGAGEMENT_DB)
+        sync_stats.add_stats(_sync_engagement_db_message_to_coda(
+            engagement_db, coda, coda_config, dataset_config, coda_message_caches, engagement_db_message,
+            pending_writes, dry_run
+        ))
+
+    write_messages_to_engagement_db(engagement_db, pending_writes, skip_changed_messages=True)
+
+    return engagement_db_messages, sync_stats
+
+
+def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, dataset_config, coda_message_caches, cache,
+                                        dry_run=False):
     """
     Syncs messages from one engagement database dataset to Coda.
 
@@ -129,6 +356,9 @@ def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, datase
     :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
     :param dataset_config: Configuration for the dataset to sync.
     :type dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
+    :param coda_message_caches: Dictionary of Coda dataset id -> cache of the messages in that Coda dataset, for every
+                                Coda dataset in the sync configuration.
+    :type coda_message_caches: dict of str -> _CodaMessageCache
     :param cache: Coda sync cache.
     :type cache: src.engagement_db_coda_sync.cache.CodaSyncCache | None
     :param dry_run: Whether to perform a dry run.
@@ -137,34 +367,37 @@ def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, datase
     :rtype: src.engagement_db_coda_sync.sync_stats.EngagementDBToCodaSyncStats
     """
     last_seen_message = None if cache is None else cache.get_last_seen_message(dataset_config.engagement_db_dataset)
-    synced_messages = 0
+    synced_messages_count = 0
     synced_message_ids = set()
+    if last_seen_message is None:
+        # We're going to sync every message in this dataset, so download the Coda dataset once up-front rather than
+        # looking up each message individually.
+        coda_message_caches[dataset_config.coda_dataset_id].prefetch_all_messages()
 
     sync_stats = EngagementDBToCodaSyncStats()
 
-    first_run = True
-    while first_run or last_seen_message is not None:
-        first_run = False
-
-        last_seen_message, message_sync_stats = _sync_next_engagement_db_message_to_coda(
-            engagement_db.transaction(), engagement_db, coda, coda_config, dataset_config, last_seen_message, dry_run
+    while True:
+        synced_messages, batch_sync_stats = _sync_next_engagement_db_messages_to_coda_batch(
+            engagement_db, coda, coda_config, dataset_config, coda_message_caches, last_seen_message, dry_run
         )
-        sync_stats.add_stats(message_sync_stats)
-
-        if last_seen_message is not None:
-            synced_messages += 1
-            synced_message_ids.add(last_seen_message.message_id)
-            if cache is not None and not dry_run:
-                cache.set_last_seen_message(dataset_config.engagement_db_dataset, last_seen_message)
-
-            # We can see the same message twice in a run if we need to set a coda id, labels, or do WS correction,
-            # because in these cases we'll write back to one of the retrieved documents.
-            # Log both the number of message objects processed and the number of unique message ids seen so we can
-            # monitor both.
-            log.info(f"Synced {synced_messages} message objects ({len(synced_message_ids)} unique message ids) in "
-                     f"dataset {dataset_config.engagement_db_dataset}")
-        else:
+        sync_stats.add_stats(batch_sync_stats)
+
+        if len(synced_messages) == 0:
             log.info(f"No more new messages in dataset {dataset_config.engagement_db_dataset}")
+            break
+
+        last_seen_message = synced_messages[-1]
+        synced_messages_count += len(synced_messages)
+        synced_message_ids.update(msg.message_id for msg in synced_messages)
+        if cache is not None and not dry_run:
+            cache.set_last_seen_message(dataset_config.engagement_db_dataset, last_seen_message)
+
+        # We can see the same message twice in a run if we need to set a coda id, labels, or do WS correction,
+        # because in these cases we'll write back to one of the retrieved documents.
+        # Log both the number of message objects processed and the number of unique message ids seen so we can
+        # monitor both.
+        log.info(f"Synced {synced_messages_count} message objects ({len(synced_message_ids)} unique message ids) in "
+                 f"dataset {dataset_config.engagement_db_dataset}")
 
     return sync_stats
 
@@ -197,13 +430,34 @@ def sync_engagement_db_to_coda(engagement_db, coda, coda_config, cache_path=None
         log.warning("Running without --dry-run may cause more reads than suggested here, because any update made to "
                     "an engagement db message when syncing it will result in it being synced again")
 
-    # Sync each dataset in turn to Coda
-    dataset_to_sync_stats = dict()  # of engagement db dataset -> EngagementDBToCodaSyncStats
+    # Create one cache of Coda messages per Coda dataset, shared by all the dataset syncs. Fixing a WS cycle while
+    # syncing one dataset clears the labels in the Coda datasets of the other datasets in the cycle, so it needs to
+    # invalidate those datasets' caches too.
+    coda_message_caches = dict()  # of coda dataset id -> _CodaMessageCache
     for dataset_config in coda_config.dataset_configurations:
-        log.info(f"Syncing engagement db dataset {dataset_config.engagement_db_dataset} to Coda dataset "
-                 f"{dataset_config.coda_dataset_id}...")
-        dataset_sync_stats = _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, dataset_config, cache, dry_run)
-        dataset_to_sync_stats[dataset_config.engagement_db_dataset] = dataset_sync_stats
+        if dataset_config.coda_dataset_id not in coda_message_caches:
+            coda_message_caches[dataset_config.coda_dataset_id] = _CodaMessageCache(
+                coda, dataset_config.coda_dataset_id
+            )
+
+    # Sync the datasets to Coda concurrently. Messages within a dataset have to be synced in turn, because each
+    # message is found by querying for the next message after the previous one, but each dataset is synced
+    # independently and spends most of its time waiting on Firestore and Coda.
+    dataset_to_sync_stats = dict()  # of engagement db dataset -> EngagementDBToCodaSyncStats
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_DATASET_SYNCS) as executor:
+        future_to_dataset_config = dict()
+        for dataset_config in coda_config.dataset_configurations:
+            log.info(f"Syncing engagement db dataset {dataset_config.engagement_db_dataset} to Coda dataset "
+                     f"{dataset_config.coda_dataset_id}...")
+            future = executor.submit(
+                _sync_engagement_db_dataset_to_coda,
+                engagement_db, coda, coda_config, dataset_config, coda_message_caches, cache, dry_run
+            )
+            future_to_dataset_config[future] = dataset_config
+
+        for future in as_completed(future_to_dataset_config):
+            dataset_config = future_to_dataset_config[future]
+            dataset_to_sync_stats[dataset_config.engagement_db_dataset] = future.result()
 
     # Log the summaries of actions taken for each dataset then for all datasets combined.
     all_sync_stats = EngagementDBToCodaSyncStats()
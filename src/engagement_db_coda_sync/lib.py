@@ -15,7 +15,6 @@ from src.engagement_db_coda_sync.sync_stats import CodaSyncEvents, EngagementDBT
 
 log = Logger(__name__)
 
-
 def _get_coda_users_from_gcloud(dataset_users_file_url, google_cloud_credentials_file_path):
     return json.loads(google_cloud_utils.download_blob_to_string(
         google_cloud_credentials_file_path, dataset_users_file_url
@@ -114,7 +113,25 @@ def ensure_coda_users_and_code_schemes_up_to_date(coda, coda_config, google_clou
             log.info(f"Code schemes are up to date")
 
 
-def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_scheme, engagement_db_message, dry_run=False):
+def _get_code_scheme_name(scheme_id, coda_dataset_config, ws_correct_dataset_code_scheme):
+    """
+    :param scheme_id: Id of the code scheme to get the name of.
+    :type scheme_id: str
+    :param coda_dataset_config: Configuration for the Coda dataset the code scheme is in.
+    :type coda_dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
+    :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
+    :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
+    :return: Name of the code scheme with id `scheme_id`.
+    :rtype: str
+    """
+    code_schemes = [c.code_scheme for c in coda_dataset_config.code_scheme_configurations]
+    code_schemes.append(ws_correct_dataset_code_scheme)
+    for code_scheme in code_schemes:
+        if code_scheme.scheme_id == scheme_id:
+            return code_scheme.name
+
+
+def _add_message_to_coda(coda, coda_dataset_config, coda_config, engagement_db_message, dry_run=False):
     """
     Adds a message to Coda.
 
@@ -126,13 +143,15 @@ def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_sche
     :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
     :param coda_dataset_config: Configuration for adding the message.
     :type coda_dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
-    :param ws_correct_dataset_code_scheme: WS Correct Dataset code scheme for the Coda dataset, used to validate any
-                                           existing labels, where applicable.
-    :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
+    :param coda_config: Coda sync configuration, used to validate any existing labels against the WS Correct Dataset
+                        code scheme, where applicable.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
     :param engagement_db_message: Message to add to Coda.
     :type engagement_db_message: engagement_database.data_models.Message
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :return: The message that was added to Coda.
+    :rtype: core_data_modules.data_models.Message
     """
     log.debug("Adding message to Coda")
 
@@ -148,25 +167,25 @@ def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_sche
         # Ensure the existing labels are valid under the code schemes being copied to, by checking the label's scheme id
         # exists in this dataset's code schemes or the ws correct dataset scheme, and that the code id is in the
         # code scheme.
-        valid_code_schemes = [c.code_scheme for c in coda_dataset_config.code_scheme_configurations]
-        valid_code_schemes.append(ws_correct_dataset_code_scheme)
-        valid_code_schemes_lut = {code_scheme.scheme_id: code_scheme for code_scheme in valid_code_schemes}
+        ws_correct_dataset_code_scheme = coda_config.ws_correct_dataset_code_scheme
+        valid_code_ids_lut = coda_dataset_config.get_valid_code_ids_lut()
         for label in engagement_db_message.labels:
-            assert label.scheme_id in valid_code_schemes_lut.keys(), \
-                f"Scheme id {label.scheme_id} not valid for Coda dataset {coda_dataset_config.coda_dataset_id}"
-            code_scheme = valid_code_schemes_lut[label.scheme_id]
-            valid_codes = code_scheme.codes
-            valid_code_ids = [code.code_id for code in valid_codes]
+            if label.scheme_id == ws_correct_dataset_code_scheme.scheme_id:
+                valid_code_ids = coda_config.get_ws_correct_dataset_code_ids()
+            else:
+                assert label.scheme_id in valid_code_ids_lut, \
+                    f"Scheme id {label.scheme_id} not valid for Coda dataset {coda_dataset_config.coda_dataset_id}"
+                valid_code_ids = valid_code_ids_lut[label.scheme_id]
             assert label.code_id == "SPECIAL-MANUALLY_UNCODED" or label.code_id in valid_code_ids, \
-                f"Code ID {label.code_id} not found in Scheme {code_scheme.name} (id {label.scheme_id})"
+                f"Code ID {label.code_id} not found in Scheme " \
+                f"{_get_code_scheme_name(label.scheme_id, coda_dataset_config, ws_correct_dataset_code_scheme)} " \
+                f"(id {label.scheme_id})"
 
         coda_message.labels = engagement_db_message.labels
 
     # Otherwise, run any auto-coders that are specified.
     else:
-        for scheme_config in coda_dataset_config.code_scheme_configurations:
-            if scheme_config.auto_coder is None:
-                continue
+        for scheme_config in coda_dataset_config.get_auto_coded_scheme_configurations():
             label = CleaningUtils.apply_cleaner_to_text(scheme_config.auto_coder, engagement_db_message.text,
                                                         scheme_config.code_scheme)
             if label is not None:
@@ -176,6 +195,8 @@ def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_sche
     if not dry_run:
         coda.add_message_to_dataset(coda_dataset_config.coda_dataset_id, coda_message)
 
+    return coda_message
+
 
 def _code_for_label(label, code_schemes):
     """
@@ -215,18 +236,8 @@ def _get_ws_code(coda_message, coda_dataset_config, ws_correct_dataset_code_sche
     normal_code_schemes = [c.code_scheme for c in coda_dataset_config.code_scheme_configurations]
     ws_code_scheme = ws_correct_dataset_code_scheme
 
-    # Check for a WS code in any of the normal code schemes
+    # Check for a WS code in any of the normal code schemes, and for a code in the WS code scheme
     ws_code_in_normal_scheme = False
-    for label in coda_message.get_latest_labels():
-        if not label.checked:
-            continue
-
-        if label.scheme_id != ws_code_scheme.scheme_id:
-            code = _code_for_label(label, normal_code_schemes)
-            if code.control_code == Codes.WRONG_SCHEME:
-                ws_code_in_normal_scheme = True
-
-    # Check for a code in the WS code scheme
     code_in_ws_scheme = False
     ws_code = None
     for label in coda_message.get_latest_labels():
@@ -236,6 +247,10 @@ def _get_ws_code(coda_message, coda_dataset_config, ws_correct_dataset_code_sche
         if label.scheme_id == ws_code_scheme.scheme_id:
             code_in_ws_scheme = True
             ws_code = ws_code_scheme.get_code_with_code_id(label.code_id)
+        else:
+            code = _code_for_label(label, normal_code_schemes)
+            if code.control_code == Codes.WRONG_SCHEME:
+                ws_code_in_normal_scheme = True
 
     # Ensure there is a WS code in a normal scheme and a code in the WS scheme.
     # If there isn't, don't attempt any redirect, so we can impute a CE code later.
@@ -274,23 +289,55 @@ def clear_checked_labels_in_coda(transaction, coda, coda_dataset_id, coda_messag
     log.info(f"Clearing WS labels for Coda message '{coda_message_id}' in Coda dataset '{coda_dataset_id}'...")
     coda_message = coda.get_dataset_message(coda_dataset_id, coda_message_id, transaction)
 
-    # Reset all the WS labels in the non-WS-Correct-Dataset code schemes
+    # Reset all the WS labels in the non-WS-Correct-Dataset code schemes.
+    # Build the new labels first then prepend them all at once, rather than inserting each at the front of the labels
+    # list in turn. The new labels are reversed so they end up in the same order as with one insert per label.
+    cleared_labels = []
     for label in coda_message.get_latest_labels():
         if not label.checked:
             continue
 
-        coda_message.labels.insert(0, Label(
+        cleared_labels.append(Label(
             label.scheme_id,
             "SPECIAL-MANUALLY_UNCODED",
             TimeUtils.utc_now_as_iso_string(),
             Origin(Metadata.get_call_location(), "Pipeline WS-Cycle Fixer", "External")
         ))
+    cleared_labels.reverse()
+    coda_message.labels = cleared_labels + coda_message.labels
 
     if not dry_run:
         coda.update_dataset_message(coda_dataset_id, coda_message, transaction)
 
 
-def _fix_ws_cycle(engagement_db, coda, engagement_db_message, coda_config, transaction=None, dry_run=False):
+def _clear_ws_cycle_labels_in_coda(coda, engagement_db_message, coda_config, dry_run=False):
+    """
+    Clears all the labels on all the Coda messages in an engagement_db message's WS cycle.
+
+    :param coda: Coda instance containing the Coda messages to clear.
+    :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+    :param engagement_db_message: Engagement db message with a WS cycle.
+    :type engagement_db_message: engagement_database.data_models.Message
+    :param coda_config: Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param dry_run: Whether to perform a dry run.
+    :type dry_run: bool
+    :return: Ids of the Coda datasets that the labels were cleared in.
+    :rtype: set of str
+    """
+    datasets_to_clear = set(engagement_db_message.previous_datasets + [engagement_db_message.dataset])
+    cleared_coda_dataset_ids = set()
+    for engagement_db_dataset in datasets_to_clear:
+        coda_dataset_config = coda_config.get_dataset_config_by_engagement_db_dataset(engagement_db_dataset)
+        clear_checked_labels_in_coda(
+            coda.transaction(), coda, coda_dataset_config.coda_dataset_id, engagement_db_message.coda_id, dry_run
+        )
+        cleared_coda_dataset_ids.add(coda_dataset_config.coda_dataset_id)
+    return cleared_coda_dataset_ids
+
+
+def _fix_ws_cycle(engagement_db, coda, engagement_db_message, coda_config, transaction=None, dry_run=False,
+                  clear_labels_in_coda=True):
     """
     Fixes a WS cycle, by:
      - Clearing all the labels on all the Coda messages in the cycle[1].
@@ -312,16 +359,15 @@ def _fix_ws_cycle(engagement_db, coda, engagement_db_message, coda_config, trans
     :type transaction: google.cloud.firestore.Transaction
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :param clear_labels_in_coda: Whether to clear the labels in Coda. Set this to False if they are cleared
+                                 separately using `_clear_ws_cycle_labels_in_coda`.
+    :type clear_labels_in_coda: bool
     """
     log.warning(f"Fixing WS cycle for engagement_db message '{engagement_db_message.message_id}'...")
 
     # Clear the labels in Coda
-    datasets_to_clear = set(engagement_db_message.previous_datasets + [engagement_db_message.dataset])
-    for engagement_db_dataset in datasets_to_clear:
-        coda_dataset_config = coda_config.get_dataset_config_by_engagement_db_dataset(engagement_db_dataset)
-        clear_checked_labels_in_coda(
-            coda.transaction(), coda, coda_dataset_config.coda_dataset_id, engagement_db_message.coda_id, dry_run
-        )
+    if clear_labels_in_coda:
+        _clear_ws_cycle_labels_in_coda(coda, engagement_db_message, coda_config, dry_run)
 
     # Reset the message in the engagement db
     log.info(f"Resetting labels, dataset, and previous_dataset for engagement_db message "
@@ -339,8 +385,110 @@ def _fix_ws_cycle(engagement_db, coda, engagement_db_message, coda_config, trans
     log.info(f"Fixed WS cycle for engagement_db message '{engagement_db_message.message_id}'")
 
 
+def _get_ws_correct_dataset(ws_code, coda_config):
+    """
+    Gets the engagement db dataset that a message labelled with the given WS - Correct Dataset code should be moved to.
+
+    To determine the dataset, the following strategies are tried, in this order:
+     1. Search the dataset configurations for a match. If there is no match:
+     2. If `set_dataset_from_ws_string_value` has been set, move the message to the dataset `ws_code.string_value`.
+        Otherwise:
+     3. If the `default_ws_dataset` has been specified, move the message to this default dataset.
+    If no correct dataset is found after trying all these strategies, raises a ValueError.
+
+    :param ws_code: WS - Correct Dataset code assigned to the message.
+    :type ws_code: core_data_modules.data_models.Code
+    :param coda_config: Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :return: Engagement db dataset to move the message to.
+    :rtype: str
+    """
+    try:
+        return coda_config.get_dataset_config_by_ws_code_match_value(ws_code.match_values).engagement_db_dataset
+    except ValueError as e:
+        if coda_config.set_dataset_from_ws_string_value and ws_code.string_value in ws_code.match_values:
+            return ws_code.string_value
+
+        # No dataset configuration found with an appropriate ws_code_match_value to move the message to.
+        # Fallback to the default dataset if available, otherwise crash.
+        if coda_config.default_ws_dataset is not None:
+            return coda_config.default_ws_dataset
+
+        raise e
+
+
+def _engagement_db_message_matches_coda_message(engagement_db_message, coda_message, coda_config):
+    """
+    Checks whether an engagement database message is already up to date with its Coda message, i.e. whether
+    `_update_engagement_db_message_from_coda_message` would return without updating anything.
+
+    :param engagement_db_message: Engagement database message to check.
+    :type engagement_db_message: engagement_database.data_models.Message
+    :param coda_message: Coda message to check against.
+    :type coda_message: core_data_modules.data_models.Message
+    :param coda_config: Coda sync configuration.
+    :type coda_config:  src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :return: Whether the engagement database message matches the Coda message.
+    :rtype: bool
+    """
+    if engagement_db_message.labels != coda_message.labels:
+        return False
+
+    coda_dataset_config = coda_config.get_dataset_config_by_engagement_db_dataset(engagement_db_message.dataset)
+    ws_code = _get_ws_code(coda_message, coda_dataset_config, coda_config.ws_correct_dataset_code_scheme)
+    return ws_code is None or _get_ws_correct_dataset(ws_code, coda_config) == engagement_db_message.dataset
+
+
+def _get_ws_correction_dataset(engagement_db_message, coda_message, coda_config):
+    """
+    Gets the dataset that an engagement database message needs to be WS-corrected to, based on the labels in its Coda
+    message.
+
+    :param engagement_db_message: Engagement database message to check.
+    :type engagement_db_message: engagement_database.data_models.Message
+    :param coda_message: Coda message to check against.
+    :type coda_message: core_data_modules.data_models.Message
+    :param coda_config: Coda sync configuration.
+    :type coda_config:  src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :return: Engagement db dataset to move the message to, or None if the message doesn't need WS-correcting.
+    :rtype: str | None
+    """
+    coda_dataset_config = coda_config.get_dataset_config_by_engagement_db_dataset(engagement_db_message.dataset)
+    ws_code = _get_ws_code(coda_message, coda_dataset_config, coda_config.ws_correct_dataset_code_scheme)
+    if ws_code is None:
+        return None
+
+    correct_dataset = _get_ws_correct_dataset(ws_code, coda_config)
+    return None if correct_dataset == engagement_db_message.dataset else correct_dataset
+
+
+def _get_coda_sync_origin_details(coda_dataset_config, coda_message, serialize_coda_message=None):
+    """
+    Gets the history entry origin details to record when updating an engagement database message from a Coda message.
+
+    :param coda_dataset_config: Configuration for the Coda dataset the message was updated from.
+    :type coda_dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
+    :param coda_message: Coda message the engagement database message was updated from.
+    :type coda_message: core_data_modules.data_models.Message
+    :param serialize_coda_message: Function that returns `coda_message.to_dict(serialize_datetimes_to_str=True)`, or
+                                   None. If None, serializes `coda_message` directly.
+    :type serialize_coda_message: (function of () -> dict) | None
+    :return: Origin details.
+    :rtype: dict
+    """
+    if serialize_coda_message is None:
+        serialized_coda_message = coda_message.to_dict(serialize_datetimes_to_str=True)
+    else:
+        serialized_coda_message = serialize_coda_message()
+
+    return {"coda_dataset": coda_dataset_config.coda_dataset_id,
+            "coda_message": serialized_coda_message}
+
+
 def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagement_db_message, coda_message,
-                                                    coda_config, transaction=None, dry_run=False):
+                                                    coda_config, transaction=None, dry_run=False,
+                                                    serialize_coda_message=None, pending_writes=None,
+                                                    clear_ws_cycle_labels_in_coda=True):
     """
     Updates a message in the engagement database based on the labels in the Coda message.
 
@@ -362,6 +510,21 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
     :type transaction: google.cloud.firestore.Transaction | None
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :param serialize_coda_message: Function that returns `coda_message.to_dict(serialize_datetimes_to_str=True)`, to
+                                   record in the history entry origin of any update, or None. This is only called if
+                                   an update is needed. Pass in a memoized function when updating many engagement
+                                   database messages from the same Coda message, to avoid re-serializing it for each
+                                   one. If None, serializes `coda_message` directly.
+    :type serialize_coda_message: (function of () -> dict) | None
+    :param pending_writes: List to append label updates to, to be written later using
+                           `write_messages_to_engagement_db`, or None. If None, label updates are written immediately
+                           (in `transaction`, if specified). WS corrections are always written immediately.
+    :type pending_writes: list of (engagement_database.data_models.Message,
+                          engagement_database.data_models.HistoryEntryOrigin) | None
+    :param clear_ws_cycle_labels_in_coda: Whether to clear the labels in Coda if this fixes a WS cycle. Set this to
+                                          False if they are cleared separately using
+                                          `_clear_ws_cycle_labels_in_coda`.
+    :type clear_ws_cycle_labels_in_coda: bool
     :return: Sync events for the update.
     :rtype: list of str
     """
@@ -370,29 +533,8 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
 
     ws_code = _get_ws_code(coda_message, coda_dataset_config, coda_config.ws_correct_dataset_code_scheme)
 
-    correct_dataset = None
     # If there is a valid ws_code, find the correct_dataset.
-    if ws_code is not None:
-        # Establish the correct dataset to move this message to.
-        # To determine the dataset, the following strategies are tried, in this order:
-        #  1. Search the other dataset configurations for a match. If there is no match:
-        #  2. If `set_dataset_from_ws_string_value` has been set, move the message to the dataset
-        #     `ws_code.string_value`. Otherwise:
-        #  3. If the `default_ws_dataset` has been specified, move the message to this default dataset.
-        # If no correct dataset is found after trying all these strategies, raise a ValueError.
-        try:
-            correct_dataset = \
-                coda_config.get_dataset_config_by_ws_code_match_value(ws_code.match_values).engagement_db_dataset
-        except ValueError as e:
-            if coda_config.set_dataset_from_ws_string_value and ws_code.string_value in ws_code.match_values:
-                correct_dataset = ws_code.string_value
-
-            # No dataset configuration found with an appropriate ws_code_match_value to move the message to.
-            # Fallback to the default dataset if available, otherwise crash.
-            elif coda_config.default_ws_dataset is not None:
-                correct_dataset = coda_config.default_ws_dataset
-            else:
-                raise e
+    correct_dataset = None if ws_code is None else _get_ws_correct_dataset(ws_code, coda_config)
 
     labels_match = engagement_db_message.labels == coda_message.labels
     message_in_ws_correct_dataset = correct_dataset == engagement_db_message.dataset
@@ -414,7 +556,8 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
             log.warning(f"Message '{engagement_db_message.message_id}' is being WS-corrected from  dataset "
                         f"'{engagement_db_message.dataset}' to '{correct_dataset}', which is one of its previous "
                         f"datasets ({engagement_db_message.previous_datasets})")
-            _fix_ws_cycle(engagement_db, coda, engagement_db_message, coda_config, transaction, dry_run)
+            _fix_ws_cycle(engagement_db, coda, engagement_db_message, coda_config, transaction, dry_run,
+                          clear_ws_cycle_labels_in_coda)
             sync_events.append(CodaSyncEvents.FIX_WS_CYCLE)
             return sync_events
 
@@ -424,10 +567,8 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
         engagement_db_message.previous_datasets.append(engagement_db_message.dataset)
         engagement_db_message.dataset = correct_dataset
 
-        origin_details = {"coda_dataset": coda_dataset_config.coda_dataset_id,
-                          "coda_message": coda_message.to_dict(serialize_datetimes_to_str=True)}
-
         if not dry_run:
+            origin_details = _get_coda_sync_origin_details(coda_dataset_config, coda_message, serialize_coda_message)
             engagement_db.set_message(
                 message=engagement_db_message,
                 origin=HistoryEntryOrigin(origin_name="Coda -> Database Sync (WS Correction)", details=origin_details),
@@ -442,15 +583,14 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
     # message in Coda.
     log.debug("Updating database message labels to match those in Coda")
     engagement_db_message.labels = coda_message.labels
-    origin_details = {"coda_dataset": coda_dataset_config.coda_dataset_id,
-                      "coda_message": coda_message.to_dict(serialize_datetimes_to_str=True)}
 
     if not dry_run:
-        engagement_db.set_message(
-            message=engagement_db_message,
-            origin=HistoryEntryOrigin(origin_name="Coda -> Database Sync", details=origin_details),
-            transaction=transaction
-        )
+        origin_details = _get_coda_sync_origin_details(coda_dataset_config, coda_message, serialize_coda_message)
+        origin = HistoryEntryOrigin(origin_name="Coda -> Database Sync", details=origin_details)
+        if pending_writes is not None:
+            pending_writes.append((engagement_db_message, origin))
+        else:
+            engagement_db.set_message(message=engagement_db_message, origin=origin, transaction=transaction)
 
     sync_events.append(CodaSyncEvents.UPDATE_ENGAGEMENT_DB_LABELS)
     return sync_events
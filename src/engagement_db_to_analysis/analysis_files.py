@@ -9,6 +9,10 @@ from src.engagement_db_to_analysis.column_view_conversion import analysis_datase
 
 log = Logger(__name__)
 
+# Size of the write buffer to use when exporting csvs, so that large exports are flushed to disk in a few large writes
+# rather than many small ones.
+_EXPORT_FILE_BUFFER_SIZE_BYTES = 1024 * 1024
+
 
 def export_production_file(traced_data_iterable, analysis_config, export_path):
     """
@@ -25,12 +29,25 @@ def export_production_file(traced_data_iterable, analysis_config, export_path):
     """
     log.info(f"Exporting production file to '{export_path}'...")
     IOUtils.ensure_dirs_exist_for_file(export_path)
-    with open(export_path, "w") as f:
+    with open(export_path, "w", newline="", buffering=_EXPORT_FILE_BUFFER_SIZE_BYTES) as f:
         headers = ["participant_uuid", "timestamp"] + [c.raw_dataset for c in analysis_config.dataset_configurations]
         TracedDataCSVIO.export_traced_data_iterable_to_csv(traced_data_iterable, f, headers)
 
 
 
+def _get_matrix_headers(column_config):
+    """
+    Gets the matrix-format headers for each code in a column's code scheme e.g. "age:25", "s01e01:healthcare".
+
+    :param column_config: Column configuration to get the matrix headers for.
+    :type column_config: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :return: Tuples of (code id, matrix header) for each code in the column's code scheme, in code scheme order.
+    :rtype: list of (str, str)
+    """
+    return [(code.code_id, f"{column_config.dataset_name}:{code.string_value}")
+            for code in column_config.code_scheme.codes]
+
+
 def _get_analysis_file_headers(pipeline_config, export_timestamps=False):
     """
     Gets the headers for an analysis file.
@@ -56,23 +73,30 @@ def _get_analysis_file_headers(pipeline_config, export_timestamps=False):
         for membership_group in pipeline_config.analysis.membership_group_configuration.membership_group_csv_urls.keys():
             headers.append(membership_group)
     
+    seen_headers = set(headers)
     column_configs = analysis_dataset_configs_to_column_configs(pipeline_config.analysis.dataset_configurations)
     for config in column_configs:
         # Add headers for each label in this column's code scheme, in matrix format e.g. "age:25", "s01e01:healthcare"
-        for code in config.code_scheme.codes:
-            headers.append(f"{config.dataset_name}:{code.string_value}")
+        for _, matrix_header in _get_matrix_headers(config):
+            headers.append(matrix_header)
+            seen_headers.add(matrix_header)
 
         # Add the raw field to the headers.
         # If we've already seen this raw_field, move it to the end of the headers added so far so that the raw fields
         # always appear after their respective code schemes e.g. county labels, constituency labels, raw location.
-        if config.raw_field in headers:
+        # (Check membership with the set of headers seen so far, so `headers` is only scanned when there is a header
+        #  to move. Headers are only ever removed just before being re-appended, so this set always contains exactly
+        #  the headers in `headers`).
+        if config.raw_field in seen_headers:
             headers.remove(config.raw_field)
         headers.append(config.raw_field)
+        seen_headers.add(config.raw_field)
 
     return headers
 
 
-def _get_analysis_file_row(column_view_td, pipeline_config, export_timestamps=False):
+def _get_analysis_file_row(column_view_td, pipeline_config, column_configs_with_matrix_headers, row_template,
+                           export_timestamps=False):
     """
     Gets a row of an analysis file from a Traced Data object in column-view format
 
@@ -80,16 +104,21 @@ def _get_analysis_file_row(column_view_td, pipeline_config, export_timestamps=Fa
     :type column_view_td: core_data_modules.traced_data.TracedData
     :param pipeline_config: Pipeline configuration.
     :type pipeline_config: PipelineConfiguration
+    :param column_configs_with_matrix_headers: Tuples of (column configuration, (code id, matrix header) pairs that
+                                               column configuration decides the value of) for each column configuration
+                                               derived from the `pipeline_config`'s analysis dataset configurations.
+                                               Pass these in rather than re-deriving them for every row.
+    :type column_configs_with_matrix_headers:
+        list of (core_data_modules.analysis.analysis_utils.AnalysisConfiguration, list of (str, str))
+    :param row_template: Row to copy as the starting point for this row, with every matrix header set to
+                         Codes.MATRIX_0.
+    :type row_template: dict
     :return: Dictionary representing a row of an analysis file
     :rtype: dict
     """
-    
-    column_configs = analysis_dataset_configs_to_column_configs(pipeline_config.analysis.dataset_configurations)
-
-    row = {
-        "participant_uuid": column_view_td["participant_uuid"],
-        "consent_withdrawn": column_view_td["consent_withdrawn"]
-    }
+    row = row_template.copy()
+    row["participant_uuid"] = column_view_td["participant_uuid"]
+    row["consent_withdrawn"] = column_view_td["consent_withdrawn"]
 
     if pipeline_config.analysis.membership_group_configuration is not None:
         for membership_group in pipeline_config.analysis.membership_group_configuration.membership_group_csv_urls.keys():
@@ -98,17 +127,16 @@ def _get_analysis_file_row(column_view_td, pipeline_config, export_timestamps=Fa
     if export_timestamps:
         row["timestamp"] = column_view_td["timestamp"]
 
-    for config in column_configs:
+    for config, matrix_headers in column_configs_with_matrix_headers:
         # Raw field
         row[config.raw_field] = column_view_td[config.raw_field]
 
-        # Labels, in matrix config
-        td_code_ids = [label["CodeID"] for label in column_view_td[config.coded_field]]
-        for code in config.code_scheme.codes:
-            if code.code_id in td_code_ids:
-                row[f"{config.dataset_name}:{code.string_value}"] = Codes.MATRIX_1
-            else:
-                row[f"{config.dataset_name}:{code.string_value}"] = Codes.MATRIX_0
+        # Labels, in matrix config. Every matrix header starts as Codes.MATRIX_0 in the row template, so only the codes
+        # this column has been labelled with need setting.
+        td_code_ids = {label["CodeID"] for label in column_view_td[config.coded_field]}
+        for code_id, matrix_header in matrix_headers:
+            if code_id in td_code_ids:
+                row[matrix_header] = Codes.MATRIX_1
 
     return row
 
@@ -129,11 +157,36 @@ def export_analysis_file(traced_data_iterable, pipeline_config, export_path, exp
     log.info(f"Exporting analysis file to '{export_path}'...")
 
     IOUtils.ensure_dirs_exist_for_file(export_path)
-    with open(export_path, "w") as f:
+    with open(export_path, "w", newline="", buffering=_EXPORT_FILE_BUFFER_SIZE_BYTES) as f:
         headers = _get_analysis_file_headers(pipeline_config, export_timestamps)
-        writer = csv.DictWriter(f, fieldnames=headers)
-        writer.writeheader()
-
-        for td in traced_data_iterable:
-            row = _get_analysis_file_row(td, pipeline_config, export_timestamps)
-            writer.writerow(row)
+        column_configs = analysis_dataset_configs_to_column_configs(pipeline_config.analysis.dataset_configurations)
+
+        # Work out which code decides the value of each matrix header. If a matrix header is produced by more than one
+        # code, the last one to set it decides its value, so only keep each matrix header under that last code.
+        # This lets each row start from a template with every matrix header set to Codes.MATRIX_0, and then only set
+        # the Codes.MATRIX_1 cells.
+        column_configs_with_matrix_headers = []
+        assigned_matrix_headers = set()
+        for config in reversed(column_configs):
+            matrix_headers = []
+            for code_id, matrix_header in reversed(_get_matrix_headers(config)):
+                if matrix_header not in assigned_matrix_headers:
+                    matrix_headers.append((code_id, matrix_header))
+                    assigned_matrix_headers.add(matrix_header)
+            matrix_headers.reverse()
+            column_configs_with_matrix_headers.append((config, matrix_headers))
+        column_configs_with_matrix_headers.reverse()
+        row_template = dict.fromkeys(assigned_matrix_headers, Codes.MATRIX_0)
+
+        # Write rows as lists in header order with a plain csv.writer, rather than with a csv.DictWriter, to avoid the
+        # DictWriter's extra per-row check of each row's keys against the headers.
+        writer = csv.writer(f)
+        writer.writerow(headers)
+
+        # Hand all the rows to a single writerows call, so the per-row write loop runs inside the csv module.
+        rows = (
+            _get_analysis_file_row(td, pipeline_config, column_configs_with_matrix_headers, row_template,
+                                   export_timestamps)
+            for td in traced_data_iterable
+        )
+        writer.writerows([row.get(header, "") for header in headers] for row in rows)
@@ -1,6 +1,6 @@
 from os import path
-import json
 
+import orjson
 from core_data_modules.util import IOUtils
 
 from src.common.cache import Cache
@@ -43,8 +43,8 @@ class AnalysisCache(Cache):
         """
         export_file_path = path.join(f"{self.cache_dir}/rapid_pro_adverts/{group_name}.jsonl")
         IOUtils.ensure_dirs_exist_for_file(export_file_path)
-        with open(export_file_path, "w") as f:
-            f.write(json.dumps(participants_uuids))
+        with open(export_file_path, "wb") as f:
+            f.write(orjson.dumps(participants_uuids))
 
     def get_synced_uuids(self, group_name):
         """
@@ -58,8 +58,8 @@ class AnalysisCache(Cache):
 
         previous_export_file_path = path.join(f"{self.cache_dir}/rapid_pro_adverts/{group_name}.jsonl")
         try:
-            with open(previous_export_file_path) as f:
-                participants_uuids = json.load(f)
+            with open(previous_export_file_path, "rb") as f:
+                participants_uuids = orjson.loads(f.read())
 
         except FileNotFoundError:
             return []
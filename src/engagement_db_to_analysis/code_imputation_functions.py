@@ -21,21 +21,21 @@ log = Logger(__name__)
 
 def _clear_latest_labels(user, message_td, code_schemes):
     message = Message.from_dict(dict(message_td))
-    code_scheme_ids = [code_scheme.scheme_id for code_scheme in code_schemes]
+    # Store the scheme ids as a tuple, so each label can be prefix-matched against all of them in one startswith call.
+    code_scheme_ids = tuple(code_scheme.scheme_id for code_scheme in code_schemes)
+    cleared_labels = []
     for label in message.get_latest_labels():
-        cleared_label = None
-        for scheme_id in code_scheme_ids:
-            if label.scheme_id.startswith(scheme_id):
-                cleared_label = Label(
-                    label.scheme_id,
-                    "SPECIAL-MANUALLY_UNCODED",
-                    TimeUtils.utc_now_as_iso_string(),
-                    Origin(Metadata.get_call_location(), "Engagement DB -> Analysis", "External")
-                )
-        assert cleared_label is not None, f"Label to be cleared had scheme_id {label.scheme_id}, but this was not " \
-                                          f"present in any of the given code schemes. Do you need to add this code " \
-                                          f"scheme to the analysis configuration?"
-        _insert_label_to_message_td(user, message_td, cleared_label)
+        assert label.scheme_id.startswith(code_scheme_ids), \
+            f"Label to be cleared had scheme_id {label.scheme_id}, but this was not present in any of the given " \
+            f"code schemes. Do you need to add this code scheme to the analysis configuration?"
+        cleared_label = Label(
+            label.scheme_id,
+            "SPECIAL-MANUALLY_UNCODED",
+            TimeUtils.utc_now_as_iso_string(),
+            Origin(Metadata.get_call_location(), "Engagement DB -> Analysis", "External")
+        )
+        cleared_labels.append(cleared_label)
+    _insert_labels_to_message_td(user, message_td, cleared_labels)
 
 
 def _insert_label_to_message_td(user, message_traced_data, label):
@@ -49,9 +49,28 @@ def _insert_label_to_message_td(user, message_traced_data, label):
     :param label: New label to insert to the message_traced_data
     :type: core_data_modules.data_models.Label
     """
-    label = label.to_dict()
-    message_labels = message_traced_data["labels"].copy()
-    message_labels.insert(0, label)
+    _insert_labels_to_message_td(user, message_traced_data, [label])
+
+
+def _insert_labels_to_message_td(user, message_traced_data, labels):
+    """
+    Inserts new labels to the list of labels for this message, and writes-back to TracedData in a single update.
+
+    The labels are inserted in the same positions as calling `_insert_label_to_message_td` on each label in turn,
+    i.e. each label is inserted at the front, so the last label ends up first.
+
+    :param user: Identifier of user running the pipeline.
+    :type user: str
+    :param message_traced_data: Message TracedData object to insert the labels to.
+    :type message_traced_data: TracedData
+    :param labels: New labels to insert to the message_traced_data.
+    :type labels: list of core_data_modules.data_models.Label
+    """
+    if len(labels) == 0:
+        return
+
+    message_labels = [label.to_dict() for label in reversed(labels)]
+    message_labels.extend(message_traced_data["labels"])
     message_traced_data.append_data(
         {"labels": message_labels},
         Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
@@ -136,7 +155,7 @@ def _impute_not_reviewed_labels(user, messages_traced_data, analysis_dataset_con
              f"imputed {Codes.CODING_ERROR} labels for {messages_with_ce_imputed} messages")
 
 
-def _code_for_label(label, code_schemes):
+def _code_for_label(label, code_schemes, code_schemes_by_label_scheme_id=None):
     """
     Returns the code for the given label.
 
@@ -147,11 +166,21 @@ def _code_for_label(label, code_schemes):
     :type label: core_data_modules.data_models.Label
     :param code_schemes: Code schemes to check for the given label.
     :type code_schemes: list of core_data_modules.data_models.CodeScheme
+    :param code_schemes_by_label_scheme_id: Optional cache of label scheme id -> the code scheme in `code_schemes` it
+                                            belongs to. If provided, label scheme ids found in the cache skip searching
+                                            `code_schemes`, and newly resolved scheme ids are added to the cache.
+                                            The cache must only be used with the same `code_schemes`.
+    :type code_schemes_by_label_scheme_id: dict of str -> core_data_modules.data_models.CodeScheme | None
     :return: Code for the label.
     :rtype: core_data_modules.data_models.Code
     """
+    if code_schemes_by_label_scheme_id is not None and label.scheme_id in code_schemes_by_label_scheme_id:
+        return code_schemes_by_label_scheme_id[label.scheme_id].get_code_with_code_id(label.code_id)
+
     for code_scheme in code_schemes:
         if label.scheme_id.startswith(code_scheme.scheme_id):
+            if code_schemes_by_label_scheme_id is not None:
+                code_schemes_by_label_scheme_id[label.scheme_id] = code_scheme
             return code_scheme.get_code_with_code_id(label.code_id)
 
     raise ValueError(f"Label's scheme id '{label.scheme_id}' is not in any of the given `code_schemes` "
@@ -177,24 +206,23 @@ def _impute_ws_coding_errors(user, messages_traced_data, analysis_dataset_config
     """
     log.info(f"Imputing {Codes.CODING_ERROR} labels for WS codes...")
     imputed_labels = 0
+    # Cache each analysis dataset config's normal code schemes, and the code scheme that each label scheme id resolves
+    # to under them, so these are worked out once per config rather than once per message/label.
+    normal_code_schemes_by_config = dict()
+    code_schemes_by_label_scheme_id_by_config = dict()
     for message_td in messages_traced_data:
         message = Message.from_dict(dict(message_td))
 
         message_analysis_config = analysis_dataset_config_for_message(analysis_dataset_configs, message)
-        normal_code_schemes = [c.code_scheme for c in message_analysis_config.coding_configs]
-
-        # Check for a WS code in any of the normal code schemes
+        if message_analysis_config not in normal_code_schemes_by_config:
+            normal_code_schemes_by_config[message_analysis_config] = \
+                [c.code_scheme for c in message_analysis_config.coding_configs]
+            code_schemes_by_label_scheme_id_by_config[message_analysis_config] = dict()
+        normal_code_schemes = normal_code_schemes_by_config[message_analysis_config]
+        code_schemes_by_label_scheme_id = code_schemes_by_label_scheme_id_by_config[message_analysis_config]
+
+        # Check for a WS code in any of the normal code schemes, and for a code in the WS code scheme
         ws_code_in_normal_scheme = False
-        for label in message.get_latest_labels():
-            if not label.checked:
-                continue
-
-            if label.scheme_id != ws_correct_dataset_code_scheme.scheme_id:
-                code = _code_for_label(label, normal_code_schemes)
-                if code.control_code == Codes.WRONG_SCHEME:
-                    ws_code_in_normal_scheme = True
-
-        # Check for a code in the WS code scheme
         code_in_ws_scheme = False
         for label in message.get_latest_labels():
             if not label.checked:
@@ -202,6 +230,10 @@ def _impute_ws_coding_errors(user, messages_traced_data, analysis_dataset_config
 
             if label.scheme_id == ws_correct_dataset_code_scheme.scheme_id:
                 code_in_ws_scheme = True
+            else:
+                code = _code_for_label(label, normal_code_schemes, code_schemes_by_label_scheme_id)
+                if code.control_code == Codes.WRONG_SCHEME:
+                    ws_code_in_normal_scheme = True
 
         if ws_code_in_normal_scheme != code_in_ws_scheme:
             imputed_labels += 1
@@ -214,6 +246,7 @@ def _impute_ws_coding_errors(user, messages_traced_data, analysis_dataset_config
             _clear_latest_labels(user, message_td, normal_code_schemes + [ws_correct_dataset_code_scheme])
 
             # Append a CE code under every normal + WS code scheme
+            ce_labels = []
             for code_scheme in normal_code_schemes + [ws_correct_dataset_code_scheme]:
                 ce_label = CleaningUtils.make_label_from_cleaner_code(
                     code_scheme,
@@ -221,7 +254,8 @@ def _impute_ws_coding_errors(user, messages_traced_data, analysis_dataset_config
                     Metadata.get_call_location(),
                     set_checked=True
                 )
-                _insert_label_to_message_td(user, message_td, ce_label)
+                ce_labels.append(ce_label)
+            _insert_labels_to_message_td(user, message_td, ce_labels)
 
     log.info(f"Imputed {imputed_labels} {Codes.CODING_ERROR} labels for WS codes")
 